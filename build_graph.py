@@ -0,0 +1,125 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import metrics
+
+_local = threading.local()
+# Most steps of one build run at once, 1 runs them in order, e.g. so replays make calls in the recorded order
+step_workers = 4
+
+
+class BuildCancelled(Exception):
+    """
+    A build was stopped before all of its steps ran
+    """
+
+
+class BuildStep:
+    """
+    A method of an object being built, with the attributes it reads and writes
+    """
+
+    def __init__(self, name, inputs=(), outputs=()):
+        self.name = name
+        self.inputs = set(inputs)
+        self.outputs = set(outputs)
+
+    def __repr__(self):
+        return f'BuildStep({self.name})'
+
+
+def current_step():
+    """
+    :return: name of the build step running on this thread, or None
+    """
+    return getattr(_local, 'step', None)
+
+
+def get_dependencies(steps):
+    """
+    Work out which earlier steps each step has to wait for. A step waits for an earlier one when it reads
+    something the earlier one writes, writes something it writes, or writes something it reads, so running
+    independent steps at the same time gives the same result as running them in order.
+    :param steps: list of BuildStep in the order they would run sequentially
+    :return: a dictionary of step name to set of step names
+    """
+    dependencies = {}
+    for j, step in enumerate(steps):
+        dependencies[step.name] = set()
+        for earlier in steps[:j]:
+            if earlier.outputs & step.inputs or earlier.outputs & step.outputs or earlier.inputs & step.outputs:
+                dependencies[step.name].add(earlier.name)
+    return dependencies
+
+
+def get_downstream(steps, names):
+    """
+    Get the given steps and every step that depends on them, directly or not
+    :param steps: list of BuildStep
+    :param names: names of the steps to start from
+    :return: set of step names
+    """
+    dependencies = get_dependencies(steps)
+    selected = set(names)
+    for step in steps:
+        if dependencies[step.name] & selected:
+            selected.add(step.name)
+    return selected
+
+
+def run_steps(obj, steps, only=None, workers=None, stop=None):
+    """
+    Run build steps on obj, starting each one as soon as the steps it depends on have finished. The first
+    exception stops any further steps from starting and is raised once running steps finish.
+    :param obj: object the step methods belong to
+    :param steps: list of BuildStep in the order they would run sequentially
+    :param only: names of steps to re-run along with the steps downstream of them, None runs everything
+    :param workers: most steps to run at once, defaults to step_workers
+    :param stop: threading.Event, once set no further steps start and BuildCancelled is raised
+    :return: a dictionary of step name to seconds taken
+    """
+    if workers is None:
+        workers = step_workers
+    if only is not None:
+        selected = get_downstream(steps, only)
+        steps = [step for step in steps if step.name in selected]
+    names = {step.name for step in steps}
+    dependencies = {name: deps & names for name, deps in get_dependencies(steps).items()}
+    timings = {}
+
+    def run(step):
+        _local.step = step.name
+        start = time.perf_counter()
+        try:
+            getattr(obj, step.name)()
+        finally:
+            timings[step.name] = time.perf_counter() - start
+            metrics.get_metrics().record('build_step', timings[step.name], step=step.name)
+            _local.step = None
+
+    done = set()
+    waiting = list(steps)
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while waiting or running:
+            if error is None and stop is not None and stop.is_set():
+                error = BuildCancelled(f'Stopped with {len(waiting)} steps left')
+            if error is None:
+                for step in [step for step in waiting if dependencies[step.name] <= done]:
+                    waiting.remove(step)
+                    running[executor.submit(run, step)] = step
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                if future.exception() is not None and error is None:
+                    error = future.exception()
+                done.add(step.name)
+    if error is not None:
+        raise error
+
+    logging.info('Build steps: ' + ', '.join(f'{name} {seconds:.2f}s' for name, seconds in timings.items()))
+    return timings
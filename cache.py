@@ -0,0 +1,234 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+import metrics
+
+default_path = 'cache.sqlite'
+
+
+class Cache:
+    """
+    A persistent key value cache backed by SQLite with per-entry expiry and least recently used eviction
+    once the stored size passes max_bytes. Recently used entries are also memoized in process. Several
+    worker processes can share one cache file, access times are written in batches to keep writes rare.
+    """
+
+    def __init__(self, path=default_path, max_bytes=50e6, memo_size=1024, touch_batch_size=100, touch_interval=60):
+        """
+        :param path: path of the SQLite file
+        :param max_bytes: size to evict down to
+        :param memo_size: number of entries memoized in process
+        :param touch_batch_size: access times buffered before they are written
+        :param touch_interval: most seconds an access time stays buffered
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memo_size = memo_size
+        self.memo = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.touch_batch_size = touch_batch_size
+        self.touch_interval = touch_interval
+        # (namespace, key) to last access time not yet written
+        self.touched = {}
+        self.last_touch_flush = time.time()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'namespace TEXT, key TEXT, value BLOB, size INTEGER, expires REAL, accessed REAL, '
+            'PRIMARY KEY (namespace, key))'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self.conn.commit()
+        # Running estimate of the stored size, other processes' writes are picked up whenever evict runs
+        self.size = self.stored_size()
+
+    @staticmethod
+    def make_key(*args, **kwargs):
+        """
+        Normalize arguments into a stable key, so parameter order and types don't matter
+        :return: key string
+        """
+        return json.dumps([args, kwargs], sort_keys=True, default=str)
+
+    def get(self, namespace, key, default=None):
+        """
+        Get a value from the cache
+        :param namespace: group of keys, e.g. an API endpoint
+        :param key: key within the namespace
+        :param default: returned when the key is missing or expired
+        :return: cached value
+        """
+        now = time.time()
+        with self.lock:
+            memo_key = (namespace, key)
+            if memo_key in self.memo:
+                value, expires = self.memo[memo_key]
+                if expires is None or expires > now:
+                    self.memo.move_to_end(memo_key)
+                    # Keep the entry recent on disk too, so eviction doesn't take the hottest entries first
+                    self.touch(memo_key, now)
+                    self.hits += 1
+                    metrics.count('cache_hits', namespace=namespace)
+                    return value
+                del self.memo[memo_key]
+
+            row = self.conn.execute(
+                'SELECT value, expires FROM cache WHERE namespace = ? AND key = ?', (namespace, key)
+            ).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                self.misses += 1
+                metrics.count('cache_misses', namespace=namespace)
+                return default
+
+            self.touch(memo_key, now)
+            value = self.deserialize(row[0])
+            self.remember(memo_key, value, row[1])
+            self.hits += 1
+            metrics.count('cache_hits', namespace=namespace)
+            return value
+
+    def contains(self, namespace, key):
+        sentinel = object()
+        return self.get(namespace, key, sentinel) is not sentinel
+
+    def set(self, namespace, key, value, ttl=None):
+        """
+        Store a value in the cache
+        :param namespace: group of keys, e.g. an API endpoint
+        :param key: key within the namespace
+        :param value: JSON serializable value or bytes
+        :param ttl: seconds until the entry expires, None to keep until evicted
+        """
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        blob = self.serialize(value)
+        with self.lock:
+            self.touched.pop((namespace, key), None)
+            old_size = self.entry_size(namespace, key)
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cache (namespace, key, value, size, expires, accessed) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (namespace, key, blob, len(blob), expires, now)
+            )
+            self.conn.commit()
+            self.size += len(blob) - old_size
+            self.remember((namespace, key), value, expires)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def delete(self, namespace, key):
+        with self.lock:
+            self.memo.pop((namespace, key), None)
+            self.touched.pop((namespace, key), None)
+            self.size -= self.entry_size(namespace, key)
+            self.conn.execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (namespace, key))
+            self.conn.commit()
+
+    def entry_size(self, namespace, key):
+        row = self.conn.execute(
+            'SELECT size FROM cache WHERE namespace = ? AND key = ?', (namespace, key)
+        ).fetchone()
+        return row[0] if row is not None else 0
+
+    def stored_size(self):
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def touch(self, memo_key, now):
+        """
+        Buffer an access time, writing the buffer once it is big or old enough
+        """
+        self.touched[memo_key] = now
+        if len(self.touched) >= self.touch_batch_size or now - self.last_touch_flush >= self.touch_interval:
+            self.flush_touched()
+
+    def flush_touched(self):
+        with self.lock:
+            if len(self.touched) > 0:
+                self.conn.executemany(
+                    'UPDATE cache SET accessed = ? WHERE namespace = ? AND key = ?',
+                    [(accessed, namespace, key) for (namespace, key), accessed in self.touched.items()]
+                )
+                self.conn.commit()
+                self.touched.clear()
+            self.last_touch_flush = time.time()
+
+    def remember(self, memo_key, value, expires):
+        self.memo[memo_key] = (value, expires)
+        self.memo.move_to_end(memo_key)
+        while len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+
+    def evict(self):
+        """
+        Drop expired entries, then least recently used entries until the cache fits in max_bytes. Runs once the
+        running size estimate passes max_bytes, and resets the estimate to the stored size.
+        """
+        self.conn.execute('DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+        total = self.stored_size()
+        if total > self.max_bytes:
+            # Evict by up to date access times
+            self.flush_touched()
+            excess = total - self.max_bytes
+            rows = self.conn.execute('SELECT namespace, key, size FROM cache ORDER BY accessed').fetchall()
+            for namespace, key, size in rows:
+                if excess <= 0:
+                    break
+                self.conn.execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (namespace, key))
+                self.memo.pop((namespace, key), None)
+                excess -= size
+                total -= size
+            logging.info(f'Evicted cache entries to stay under {self.max_bytes} bytes')
+        self.conn.commit()
+        self.size = total
+
+    def clear(self, namespace=None):
+        with self.lock:
+            self.flush_touched()
+            if namespace is None:
+                self.memo.clear()
+                self.conn.execute('DELETE FROM cache')
+            else:
+                self.memo = OrderedDict((k, v) for k, v in self.memo.items() if k[0] != namespace)
+                self.conn.execute('DELETE FROM cache WHERE namespace = ?', (namespace,))
+            self.conn.commit()
+            self.size = self.stored_size()
+
+    def close(self):
+        with self.lock:
+            self.flush_touched()
+            self.conn.close()
+
+    @staticmethod
+    def serialize(value):
+        if isinstance(value, bytes):
+            return b'b' + value
+        return b'j' + json.dumps(value).encode('utf-8')
+
+    @staticmethod
+    def deserialize(blob):
+        if blob[:1] == b'b':
+            return bytes(blob[1:])
+        return json.loads(bytes(blob[1:]).decode('utf-8'))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Get the process-wide cache, opening it on first use
+    :return: Cache
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = Cache()
+    return _cache
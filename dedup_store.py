@@ -0,0 +1,221 @@
+import os
+import sys
+import csv
+import time
+import uuid
+import zlib
+import socket
+import argparse
+import sqlite3
+import logging
+import threading
+
+default_path = 'transactions.sqlite'
+legacy_csv_path = 'transactions.csv'
+# Seconds a worker holds a claim on a transaction before another worker may take it over
+lease_ttl = 15 * 60
+
+
+class DedupStore:
+    """
+    Transaction ids that have already been handled, indexed by primary key so membership checks don't
+    depend on how many ids have been stored. Added ids are buffered and written in batches, or straight
+    away when durable is set.
+
+    Several worker processes can share one store. A worker claims a transaction before building it, and
+    the claim is a lease, so a crashed worker's transactions are picked up by others once it expires.
+    """
+
+    def __init__(self, path=default_path, csv_path=legacy_csv_path, batch_size=100, lease_ttl=lease_ttl):
+        self.path = path
+        self.batch_size = batch_size
+        self.lease_ttl = lease_ttl
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.pending = set()
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS transactions (transaction_id TEXT PRIMARY KEY)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS claims (transaction_id TEXT PRIMARY KEY, owner TEXT, expires REAL)'
+        )
+        self.conn.commit()
+        if csv_path is not None and os.path.exists(csv_path) and len(self) == 0:
+            self.migrate_csv(csv_path)
+
+    def __contains__(self, transaction_id):
+        """
+        :return: True if the transaction was handled, or another worker holds a live claim on it
+        """
+        with self.lock:
+            if transaction_id in self.pending:
+                return True
+            row = self.conn.execute(
+                'SELECT 1 FROM transactions WHERE transaction_id = ? UNION ALL '
+                'SELECT 1 FROM claims WHERE transaction_id = ? AND owner != ? AND expires > ?',
+                (transaction_id, transaction_id, self.owner, time.time())
+            ).fetchone()
+            return row is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM transactions').fetchone()[0] + len(self.pending)
+
+    def add(self, transaction_id, durable=False):
+        """
+        Record a transaction as handled
+        :param transaction_id: id of the transaction
+        :param durable: write it to disk now rather than with the next batch, e.g. once a tweet is posted
+        """
+        with self.lock:
+            self.pending.add(transaction_id)
+            if durable or len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def claim(self, transaction_id):
+        """
+        Take a lease on a transaction so no other worker builds it. Fails if the transaction was handled or
+        has a live claim, including one of our own, so a transaction is only built once per lease.
+        :param transaction_id: id of the transaction
+        :return: True if the claim was taken
+        """
+        now = time.time()
+        with self.lock:
+            if transaction_id in self.pending:
+                return False
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                handled = self.conn.execute(
+                    'SELECT 1 FROM transactions WHERE transaction_id = ?', (transaction_id,)
+                ).fetchone()
+                claimed = 0
+                if handled is None:
+                    claimed = self.conn.execute(
+                        'INSERT INTO claims (transaction_id, owner, expires) VALUES (?, ?, ?) '
+                        'ON CONFLICT (transaction_id) DO UPDATE SET owner = excluded.owner, expires = excluded.expires '
+                        'WHERE claims.expires <= ?',
+                        (transaction_id, self.owner, now + self.lease_ttl, now)
+                    ).rowcount
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            return claimed == 1
+
+    def release(self, transaction_id):
+        """
+        Give up our claim on a transaction that wasn't handled, so it can be built again
+        :param transaction_id: id of the transaction
+        """
+        with self.lock:
+            self.conn.execute(
+                'DELETE FROM claims WHERE transaction_id = ? AND owner = ?', (transaction_id, self.owner)
+            )
+            self.conn.commit()
+
+    def flush(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM claims WHERE expires <= ?', (time.time(),))
+            if len(self.pending) > 0:
+                self.conn.executemany(
+                    'INSERT OR IGNORE INTO transactions (transaction_id) VALUES (?)',
+                    [(transaction_id,) for transaction_id in self.pending]
+                )
+                self.pending.clear()
+            self.conn.commit()
+
+    def compact(self):
+        """
+        Reclaim space and checkpoint the write-ahead log
+        """
+        with self.lock:
+            self.flush()
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.conn.execute('VACUUM')
+
+    def migrate_csv(self, csv_path):
+        """
+        Import transaction ids from the old transactions.csv file
+        :param csv_path: path of the csv file
+        """
+        with open(csv_path, 'r') as csv_file:
+            reader_obj = csv.reader(csv_file)
+            transaction_ids = [row[0] for row in reader_obj if len(row) > 0]
+        self.import_ids(transaction_ids)
+        logging.info(f'Migrated {len(transaction_ids)} transactions from {csv_path}')
+
+    def import_ids(self, transaction_ids):
+        """
+        Record many transactions as handled in one write
+        :param transaction_ids: iterable of transaction ids
+        """
+        with self.lock:
+            self.conn.executemany('INSERT OR IGNORE INTO transactions (transaction_id) VALUES (?)',
+                                  [(transaction_id,) for transaction_id in transaction_ids])
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
+
+
+def read_handled(path=default_path):
+    """
+    Read the handled transaction ids of a store without opening it for writing, e.g. to snapshot it
+    :param path: path of the store
+    :return: list of transaction ids, empty if there is no store
+    """
+    if not os.path.exists(path):
+        return []
+    conn = sqlite3.connect(f'file:{os.path.abspath(path)}?mode=ro', uri=True, timeout=30)
+    try:
+        return [row[0] for row in conn.execute('SELECT transaction_id FROM transactions')]
+    finally:
+        conn.close()
+
+
+def in_shard(transaction_id, shard):
+    """
+    Split transactions between workers by a stable hash of their id
+    :param transaction_id: id of the transaction
+    :param shard: (index, count) of this worker, None for a single worker
+    :return: True if the transaction belongs to this worker
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(transaction_id.encode()) % count == index
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_dedup_store():
+    """
+    Get the process-wide dedup store, opening it on first use
+    :return: DedupStore
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = DedupStore()
+    return _store
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s: %(message)s', stream=sys.stdout, level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Maintain the store of handled transactions')
+    parser.add_argument("--db", default=default_path)
+    parser.add_argument("--migrate", help="import transaction ids from a csv file")
+    parser.add_argument("--compact", action="store_true")
+    args = vars(parser.parse_args())
+    store = DedupStore(args['db'], csv_path=None)
+    if args['migrate'] is not None:
+        store.migrate_csv(args['migrate'])
+    if args['compact']:
+        store.compact()
+    logging.info(f'{len(store)} transactions stored')
+    store.close()
@@ -1,7 +1,11 @@
-import requests
-from nameparser import HumanName
-from credentials import api_key
-from datetime import datetime
+import os
+import json
+import fcntl
+import logging
+import http_client
+import metrics
+from cache import get_cache, Cache
+from datetime import datetime, timedelta
 
 endpoints = {
     'schedule_a': 'https://api.open.fec.gov/v1/schedules/schedule_a/',
@@ -11,6 +15,34 @@ endpoints = {
     'schedule_e_by_candidate': 'https://api.open.fec.gov/v1/schedules/schedule_e/by_candidate/'
 }
 
+# Rows per API page, also the most candidate ids resolved in one request
+page_size = 100
+
+# Seconds to keep lookups cached, per endpoint. Committee and candidate details rarely change.
+cache_ttls = {
+    'committee': 24 * 60 * 60,
+    'candidate': 24 * 60 * 60,
+}
+
+# Where incremental fetches record how far they got, and how far back to re-read for late arriving rows
+checkpoint_file = 'checkpoints.json'
+checkpoint_overlap = timedelta(days=1)
+# Rolling date floors that change every run, so they don't invalidate a checkpoint
+checkpoint_ignored_params = ('min_filing_date', 'min_dissemination_date')
+
+# Local bulk data store queried instead of the API when set, see use_bulk_store
+bulk_store = None
+
+
+def use_bulk_store(path):
+    """
+    Answer schedule a/e, committee and candidate queries from a local bulk data store built with fec_bulk.py
+    :param path: path of the store, None to go back to the API
+    """
+    global bulk_store
+    from fec_bulk import BulkStore
+    bulk_store = BulkStore(path) if path is not None else None
+
 
 def api_get(endpoint, params):
     """
@@ -19,16 +51,19 @@ def api_get(endpoint, params):
     :param params: a dictionary of parameters
     :return: a json dictionary returned by the API
     """
+    from credentials import api_key
     params = {
         **params,
         **{
             'api_key': api_key,
-            'per_page': 100,
+            'per_page': page_size,
             'sort_null_only': True
         }
     }
 
-    response = requests.get(endpoint, params)
+    with metrics.span('fec_page', endpoint=endpoint.replace('https://api.open.fec.gov/v1', '')):
+        response = http_client.get(endpoint, params)
+    metrics.count('fec_api_calls')
     if response.status_code != 200:
         raise Exception('API error: ' + response.text)
         return response.json()
@@ -36,26 +71,167 @@ def api_get(endpoint, params):
         return response.json()
 
 
-def get_paged_results(endpoint, **kwargs):
+def iter_paged_results(endpoint, validate_count=True, cursor=None, on_page=None, **kwargs):
     """
-    Get all pages of results
+    Yield results one at a time as each page arrives. Stopping early skips the remaining pages.
     :param endpoint: API endpoint
-    :return: a dictionary returned by the API
+    :param validate_count: check the number of rows against the API count once every page is read
+    :param cursor: last_indexes to resume from, the count is not validated when resuming
+    :param on_page: called with the cursor used to request each page and the page response
+    :return: a generator of result dictionaries
     """
+    resumed = cursor is not None
+
     # Request first page
-    response = api_get(endpoint, kwargs)
-    results = response['results']
+    params_page = {**kwargs, **(cursor or {})}
+    response = api_get(endpoint, params_page)
+    if on_page is not None:
+        on_page(cursor, response)
+    n_results = len(response['results'])
+    yield from response['results']
 
     pages = response['pagination']['pages']
     for i in range(pages-1):
-        params_page = {**kwargs, **response['pagination']['last_indexes']}
+        cursor = response['pagination']['last_indexes']
+        if not response['results'] or cursor is None:
+            break
+        params_page = {**kwargs, **cursor}
         response = api_get(endpoint, params_page)
-        results += response['results']
+        if on_page is not None:
+            on_page(cursor, response)
+        n_results += len(response['results'])
+        yield from response['results']
+
+    if validate_count and not resumed:
+        assert n_results == response['pagination']['count'], 'Did not receive correct count of results.'
+
+
+def get_paged_results(endpoint, **kwargs):
+    """
+    Get all pages of results
+    :param endpoint: API endpoint
+    :return: a dictionary returned by the API
+    """
+    return list(iter_paged_results(endpoint, **kwargs))
+
 
-    assert len(results) == response['pagination']['count'], 'Did not receive correct count of results.'
+def get_cached_paged_results(endpoint_name, endpoint, **kwargs):
+    """
+    Get all pages of results, using the persistent cache when the same lookup was made recently
+    :param endpoint_name: key into cache_ttls
+    :param endpoint: API endpoint
+    :return: a list of results
+    """
+    cache = get_cache()
+    key = cache.make_key(endpoint, **kwargs)
+    results = cache.get(endpoint_name, key)
+    if results is None:
+        results = get_paged_results(endpoint, **kwargs)
+        cache.set(endpoint_name, key, results, ttl=cache_ttls[endpoint_name])
     return results
 
 
+def load_checkpoints():
+    """
+    Load the checkpoints of incremental fetches
+    :return: a dictionary of endpoint name to checkpoint
+    """
+    if not os.path.exists(checkpoint_file):
+        return {}
+    with open(checkpoint_file, 'r') as f:
+        return json.load(f)
+
+
+def save_checkpoint(endpoint_name, checkpoint):
+    """
+    Save the checkpoint for one endpoint, replacing the file atomically so a crash can't corrupt it. A lock
+    file stops workers saving different endpoints from overwriting each other's checkpoints.
+    :param endpoint_name: name of the endpoint
+    :param checkpoint: dictionary to save
+    """
+    with open(checkpoint_file + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        checkpoints = load_checkpoints()
+        checkpoints[endpoint_name] = checkpoint
+        tmp_file = f'{checkpoint_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(checkpoints, f, indent=2)
+        os.replace(tmp_file, checkpoint_file)
+
+
+def iter_incremental_results(endpoint_name, endpoint, min_load_date, overlap=None, **kwargs):
+    """
+    Yield results loaded since the last run. An unfinished run is resumed from the page it stopped on with
+    the dates it started with, a finished one restarts from its highest load date less the overlap. The
+    high-water mark only moves once a run reads to the end, so rows a stopped run never read aren't skipped.
+    min_load_date is the earliest date ever requested.
+    :param endpoint_name: name the checkpoint is saved under
+    :param endpoint: API endpoint
+    :param min_load_date: earliest load date to request, as YYYY-MM-DD
+    :param overlap: timedelta re-read before the last high-water mark, defaults to checkpoint_overlap
+    :param kwargs: extra params
+    :return: a generator of result dictionaries
+    """
+    if overlap is None:
+        overlap = checkpoint_overlap
+    params_key = Cache.make_key(**{k: v for k, v in kwargs.items() if k not in checkpoint_ignored_params})
+    checkpoint = load_checkpoints().get(endpoint_name)
+    cursor = None
+    high_water = None
+    run_high_water = None
+
+    if checkpoint is not None and checkpoint['params'] == params_key:
+        high_water = checkpoint['high_water']
+        if not checkpoint['complete']:
+            min_load_date = checkpoint['min_load_date']
+            cursor = checkpoint['cursor']
+            run_high_water = checkpoint.get('run_high_water')
+        elif high_water is not None:
+            resume_date = datetime.strptime(high_water[:10], '%Y-%m-%d') - overlap
+            min_load_date = max(min_load_date, resume_date.strftime('%Y-%m-%d'))
+
+    logging.info(f'Fetching {endpoint_name} loaded since {min_load_date}' + (' (resuming)' if cursor else ''))
+    # Highest load date read by this run, and the runs it resumes
+    state = {'cursor': cursor, 'run_high_water': run_high_water}
+
+    def save(complete):
+        if complete:
+            final_high_water = max(filter(None, (high_water, state['run_high_water'])), default=None)
+            save_checkpoint(endpoint_name, {
+                'params': params_key,
+                'min_load_date': min_load_date,
+                'cursor': None,
+                'high_water': final_high_water,
+                'run_high_water': None,
+                'complete': True
+            })
+        else:
+            save_checkpoint(endpoint_name, {
+                'params': params_key,
+                'min_load_date': min_load_date,
+                'cursor': state['cursor'],
+                'high_water': high_water,
+                'run_high_water': state['run_high_water'],
+                'complete': False
+            })
+
+    def on_page(page_cursor, response):
+        state['cursor'] = page_cursor
+
+    results = iter_paged_results(endpoint, cursor=cursor, on_page=on_page, min_load_date=min_load_date, **kwargs)
+    complete = False
+    try:
+        for result in results:
+            load_date = result.get('load_date')
+            if load_date is not None and (state['run_high_water'] is None or load_date > state['run_high_water']):
+                state['run_high_water'] = load_date
+            yield result
+        complete = True
+    finally:
+        # Stopped early: the page we were on is re-read next time, deduplication drops what was handled
+        save(complete)
+
+
 def get_two_year_transaction_period(year):
     """
     This is a two-year period that is derived from the year a transaction took place in the
@@ -74,27 +250,43 @@ def get_two_year_transaction_period(year):
         return year + 1
 
 
-def get_schedule_a(min_load_date, min_amount, **kwargs):
+def iter_schedule_a(min_load_date, min_amount, incremental=False, **kwargs):
     """
-    Get schedule a data
+    Stream schedule a data page by page
     :param min_load_date:
     :param min_amount:
+    :param incremental: resume from the last run's checkpoint, min_load_date is then the earliest date requested
     :param kwargs: extra params
-    :return: response
+    :return: generator of results
     """
     #two_year_transaction_period = get_two_year_transaction_period(datetime.strptime(min_load_date, '%Y-%M-%d').year)
     two_year_transaction_period = 2024
-    results = get_paged_results(
+    if bulk_store is not None:
+        return bulk_store.iter_schedule_a(
+            min_load_date=min_load_date,
+            min_amount=min_amount,
+            two_year_transaction_period=two_year_transaction_period,
+            **kwargs
+        )
+    if incremental:
+        return iter_incremental_results(
+            'schedule_a',
+            endpoint=endpoints['schedule_a'],
+            min_load_date=min_load_date,
+            min_amount=min_amount,
+            two_year_transaction_period=two_year_transaction_period,
+            **kwargs
+        )
+    return iter_paged_results(
         endpoint=endpoints['schedule_a'],
         min_load_date=min_load_date,
         min_amount=min_amount,
         two_year_transaction_period=two_year_transaction_period,
         **kwargs
     )
-    return results
 
 
-def get_schedule_e(min_load_date, min_filing_date, min_amount, **kwargs):
+def get_schedule_a(min_load_date, min_amount, **kwargs):
     """
     Get schedule a data
     :param min_load_date:
@@ -102,14 +294,54 @@ def get_schedule_e(min_load_date, min_filing_date, min_amount, **kwargs):
     :param kwargs: extra params
     :return: response
     """
-    results = get_paged_results(
+    return list(iter_schedule_a(min_load_date=min_load_date, min_amount=min_amount, **kwargs))
+
+
+def iter_schedule_e(min_load_date, min_filing_date, min_amount, incremental=False, **kwargs):
+    """
+    Stream schedule e data page by page
+    :param min_load_date:
+    :param min_filing_date:
+    :param min_amount:
+    :param incremental: resume from the last run's checkpoint, min_load_date is then the earliest date requested
+    :param kwargs: extra params
+    :return: generator of results
+    """
+    if bulk_store is not None:
+        return bulk_store.iter_schedule_e(
+            min_load_date=min_load_date,
+            min_filing_date=min_filing_date,
+            min_amount=min_amount,
+            **kwargs
+        )
+    if incremental:
+        return iter_incremental_results(
+            'schedule_e',
+            endpoint=endpoints['schedule_e'],
+            min_load_date=min_load_date,
+            min_filing_date=min_filing_date,
+            min_amount=min_amount,
+            **kwargs
+        )
+    return iter_paged_results(
         endpoint=endpoints['schedule_e'],
         min_load_date=min_load_date,
         min_filing_date=min_filing_date,
         min_amount=min_amount,
         **kwargs
     )
-    return results
+
+
+def get_schedule_e(min_load_date, min_filing_date, min_amount, **kwargs):
+    """
+    Get schedule a data
+    :param min_load_date:
+    :param min_amount:
+    :param kwargs: extra params
+    :return: response
+    """
+    return list(iter_schedule_e(min_load_date=min_load_date, min_filing_date=min_filing_date,
+                                min_amount=min_amount, **kwargs))
 
 
 def get_schedule_e_by_candidate(**kwargs):
@@ -126,11 +358,16 @@ def get_schedule_e_by_candidate(**kwargs):
 
 
 def get_committee(committee_id, cycle=None):
+    if bulk_store is not None:
+        committee = bulk_store.get_committee(committee_id, cycle)
+        if committee is not None:
+            return committee
+
     endpoint = endpoints['committee']
     if cycle is not None:
         endpoint += 'history/' + str(cycle)
 
-    results = get_paged_results(endpoint.format(committee_id=committee_id))
+    results = get_cached_paged_results('committee', endpoint.format(committee_id=committee_id))
     return results[0]
 
 
@@ -159,19 +396,63 @@ def get_party(committees):
 
 
 def get_candidate(multi=False, **kwargs):
-    results = get_paged_results(
-        endpoint=endpoints['candidate'],
-        **kwargs
-    )
+    if bulk_store is not None:
+        results = bulk_store.get_candidates(**kwargs)
+    else:
+        results = get_cached_paged_results(
+            'candidate',
+            endpoint=endpoints['candidate'],
+            **kwargs
+        )
     if len(results) == 0:
         return None
 
     if not multi:
-        parsed_name = HumanName(results[0]['name'])
-        results[0]['first_name'] = parsed_name.first
-        results[0]['last_name'] = parsed_name.last
-        return results[0]
+        return parse_candidate_name(results[0])
     else:
         return results
 
 
+def parse_candidate_name(candidate):
+    from nameparser import HumanName
+    parsed_name = HumanName(candidate['name'])
+    candidate['first_name'] = parsed_name.first
+    candidate['last_name'] = parsed_name.last
+    return candidate
+
+
+def get_candidates_by_id(candidate_ids):
+    """
+    Resolve many candidates in as few requests as possible, the candidates endpoint takes repeated candidate_id
+    parameters. Results are cached so later get_candidate(candidate_id=...) calls don't make a request.
+    :param candidate_ids: iterable of candidate ids
+    :return: a dictionary of candidate id to candidate, ids that aren't found are left out
+    """
+    candidate_ids = list(dict.fromkeys(i for i in candidate_ids if i is not None))
+    cache = get_cache()
+    candidates = {}
+    missing = []
+    for candidate_id in candidate_ids:
+        results = cache.get('candidate', cache.make_key(endpoints['candidate'], candidate_id=candidate_id))
+        if results is None:
+            missing.append(candidate_id)
+        elif len(results) > 0:
+            candidates[candidate_id] = parse_candidate_name(results[0])
+
+    for i in range(0, len(missing), page_size):
+        batch = missing[i:i + page_size]
+        if bulk_store is not None:
+            results = bulk_store.get_candidates(candidate_id=batch)
+        else:
+            results = get_paged_results(endpoints['candidate'], candidate_id=batch)
+        found = {result['candidate_id']: result for result in results}
+        for candidate_id in batch:
+            result = found.get(candidate_id)
+            if bulk_store is None:
+                key = cache.make_key(endpoints['candidate'], candidate_id=candidate_id)
+                cache.set('candidate', key, [result] if result is not None else [], ttl=cache_ttls['candidate'])
+            if result is not None:
+                candidates[candidate_id] = parse_candidate_name(result)
+    return candidates
+
+
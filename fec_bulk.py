@@ -0,0 +1,445 @@
+import csv
+import sys
+import sqlite3
+import logging
+import threading
+import argparse
+from datetime import datetime
+
+# Column layouts of the FEC bulk data files, see https://www.fec.gov/campaign-finance-data/
+committee_master_columns = [
+    'CMTE_ID', 'CMTE_NM', 'TRES_NM', 'CMTE_ST1', 'CMTE_ST2', 'CMTE_CITY', 'CMTE_ST', 'CMTE_ZIP', 'CMTE_DSGN',
+    'CMTE_TP', 'CMTE_PTY_AFFILIATION', 'CMTE_FILING_FREQ', 'ORG_TP', 'CONNECTED_ORG_NM', 'CAND_ID'
+]
+candidate_master_columns = [
+    'CAND_ID', 'CAND_NAME', 'CAND_PTY_AFFILIATION', 'CAND_ELECTION_YR', 'CAND_OFFICE_ST', 'CAND_OFFICE',
+    'CAND_OFFICE_DISTRICT', 'CAND_ICI', 'CAND_STATUS', 'CAND_PCC', 'CAND_ST1', 'CAND_ST2', 'CAND_CITY', 'CAND_ST',
+    'CAND_ZIP'
+]
+contribution_columns = [
+    'CMTE_ID', 'AMNDT_IND', 'RPT_TP', 'TRANSACTION_PGI', 'IMAGE_NUM', 'TRANSACTION_TP', 'ENTITY_TP', 'NAME', 'CITY',
+    'STATE', 'ZIP_CODE', 'EMPLOYER', 'OCCUPATION', 'TRANSACTION_DT', 'TRANSACTION_AMT', 'OTHER_ID', 'TRAN_ID',
+    'FILE_NUM', 'MEMO_CD', 'MEMO_TEXT', 'SUB_ID'
+]
+
+parties = {
+    'DEM': 'DEMOCRATIC PARTY',
+    'REP': 'REPUBLICAN PARTY',
+    'IND': 'INDEPENDENT',
+    'LIB': 'LIBERTARIAN PARTY',
+    'GRE': 'GREEN PARTY',
+    'UNK': 'UNKNOWN',
+}
+
+offices = {
+    'H': 'HOUSE',
+    'S': 'SENATE',
+    'P': 'PRESIDENT',
+}
+
+pdf_url_template = 'https://docquery.fec.gov/cgi-bin/fecimg/?{image_num}'
+
+schema = """
+CREATE TABLE IF NOT EXISTS committees (
+    committee_id TEXT PRIMARY KEY, name TEXT, designation TEXT, committee_type TEXT, party TEXT,
+    state TEXT, candidate_id TEXT
+);
+CREATE TABLE IF NOT EXISTS candidates (
+    candidate_id TEXT PRIMARY KEY, name TEXT, party TEXT, election_year INTEGER, state TEXT, office TEXT,
+    district TEXT
+);
+CREATE TABLE IF NOT EXISTS schedule_a (
+    sub_id TEXT PRIMARY KEY, committee_id TEXT, transaction_id TEXT, entity_type TEXT, name TEXT, city TEXT,
+    state TEXT, employer TEXT, occupation TEXT, date TEXT, amount REAL, other_id TEXT, image_num TEXT,
+    cycle INTEGER, load_date TEXT
+);
+CREATE TABLE IF NOT EXISTS schedule_e (
+    transaction_id TEXT, committee_id TEXT, committee_name TEXT, candidate_id TEXT, candidate_name TEXT,
+    candidate_office TEXT, candidate_office_state TEXT, amount REAL, expenditure_date TEXT,
+    dissemination_date TEXT, filing_date TEXT, support_oppose TEXT, purpose TEXT, payee TEXT, image_num TEXT,
+    cycle INTEGER, load_date TEXT, PRIMARY KEY (transaction_id, committee_id)
+);
+"""
+
+indexes = """
+CREATE INDEX IF NOT EXISTS schedule_a_committee ON schedule_a (committee_id, amount);
+CREATE INDEX IF NOT EXISTS schedule_a_load ON schedule_a (load_date, amount);
+CREATE INDEX IF NOT EXISTS schedule_e_load ON schedule_e (load_date, amount);
+CREATE INDEX IF NOT EXISTS schedule_e_candidate ON schedule_e (candidate_id);
+CREATE INDEX IF NOT EXISTS candidates_name ON candidates (name);
+"""
+
+
+def connect(path):
+    """
+    Open a bulk data store, creating the tables if needed
+    :param path: path of the SQLite file
+    :return: connection
+    """
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(schema)
+    return conn
+
+
+def parse_date(text, pattern):
+    """
+    Convert a bulk file date to ISO format
+    :param text: date string
+    :param pattern: strptime pattern of the bulk file
+    :return: YYYY-MM-DD, or None if it can't be parsed
+    """
+    try:
+        return datetime.strptime(text.strip(), pattern).strftime('%Y-%m-%d')
+    except (ValueError, AttributeError):
+        return None
+
+
+def parse_name(text):
+    """
+    Split a bulk file name, e.g. "SMITH, JOHN A", into its parts
+    :param text: name
+    :return: nameparser.HumanName
+    """
+    from nameparser import HumanName
+    return HumanName(text or '')
+
+
+def to_int(text):
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_float(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_pipe_file(filename, columns):
+    with open(filename, 'r', encoding='latin-1', newline='') as f:
+        for line in f:
+            yield dict(zip(columns, line.rstrip('\r\n').split('|')))
+
+
+def insert_batches(conn, sql, rows, batch_size=50000):
+    """
+    Insert rows in batches, committing after each one
+    :return: number of rows read
+    """
+    batch = []
+    n = 0
+    for row in rows:
+        batch.append(row)
+        n += 1
+        if len(batch) >= batch_size:
+            conn.executemany(sql, batch)
+            conn.commit()
+            batch = []
+    if batch:
+        conn.executemany(sql, batch)
+        conn.commit()
+    return n
+
+
+def ingest_committees(conn, filename):
+    rows = (
+        (r['CMTE_ID'], r['CMTE_NM'], r['CMTE_DSGN'], r['CMTE_TP'], r['CMTE_PTY_AFFILIATION'], r['CMTE_ST'] or None,
+         r['CAND_ID'] or None)
+        for r in read_pipe_file(filename, committee_master_columns)
+    )
+    return insert_batches(conn, 'INSERT OR REPLACE INTO committees VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+def ingest_candidates(conn, filename):
+    rows = (
+        (r['CAND_ID'], r['CAND_NAME'], r['CAND_PTY_AFFILIATION'], to_int(r['CAND_ELECTION_YR']),
+         r['CAND_OFFICE_ST'], r['CAND_OFFICE'], r['CAND_OFFICE_DISTRICT'])
+        for r in read_pipe_file(filename, candidate_master_columns)
+    )
+    return insert_batches(conn, 'INSERT OR REPLACE INTO candidates VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+def ingest_contributions(conn, filename, cycle, load_date, min_amount=0):
+    """
+    Load individual contributions (itcont.txt). Rows already in the store keep their original load date.
+    """
+    rows = (
+        (r['SUB_ID'], r['CMTE_ID'], r['TRAN_ID'], r['ENTITY_TP'], r['NAME'], r['CITY'], r['STATE'], r['EMPLOYER'],
+         r['OCCUPATION'], parse_date(r['TRANSACTION_DT'], '%m%d%Y'), to_float(r['TRANSACTION_AMT']),
+         r['OTHER_ID'] or None, r['IMAGE_NUM'], cycle, load_date)
+        for r in read_pipe_file(filename, contribution_columns)
+        if (to_float(r.get('TRANSACTION_AMT')) or 0) >= min_amount
+    )
+    return insert_batches(conn, 'INSERT OR IGNORE INTO schedule_a VALUES '
+                                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+def ingest_independent_expenditures(conn, filename, cycle, load_date, min_amount=0):
+    """
+    Load independent expenditures (independent_expenditure_YYYY.csv). Rows already in the store keep their
+    original load date.
+    """
+    with open(filename, 'r', encoding='latin-1', newline='') as f:
+        rows = (
+            (r['tran_id'], r['spe_id'], r['spe_nam'], r['cand_id'] or None, r['cand_name'], r['can_office'],
+             r['can_office_state'], to_float(r['exp_amo']), parse_date(r['exp_date'], '%d-%b-%y'),
+             parse_date(r['dissem_dt'], '%d-%b-%y'), parse_date(r['receipt_dat'], '%d-%b-%y'), r['sup_opp'],
+             r['pur'], r['pay'], r['image_num'], cycle, load_date)
+            for r in csv.DictReader(f)
+            if (to_float(r.get('exp_amo')) or 0) >= min_amount
+        )
+        return insert_batches(conn, 'INSERT OR IGNORE INTO schedule_e VALUES '
+                                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+def ingest(path, cycle, committees=None, candidates=None, contributions=None, independent_expenditures=None,
+           min_amount=0, load_date=None):
+    """
+    Load FEC bulk files into the store and build its indexes. The bulk files have no load date, so new rows
+    are stamped with load_date, which stands in for the API's load date in queries.
+    :param path: path of the SQLite file
+    :param cycle: two-year cycle the files belong to
+    :param committees: committee master file (cm.txt)
+    :param candidates: candidate master file (cn.txt)
+    :param contributions: individual contributions file (itcont.txt)
+    :param independent_expenditures: independent expenditures file (independent_expenditure_YYYY.csv)
+    :param min_amount: skip contributions and expenditures below this amount
+    :param load_date: YYYY-MM-DD or ISO timestamp to stamp new rows with, defaults to now
+    """
+    if load_date is None:
+        load_date = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    conn = connect(path)
+    if committees is not None:
+        logging.info(f'Loaded {ingest_committees(conn, committees)} committees')
+    if candidates is not None:
+        logging.info(f'Loaded {ingest_candidates(conn, candidates)} candidates')
+    if contributions is not None:
+        logging.info(f'Loaded {ingest_contributions(conn, contributions, cycle, load_date, min_amount)} contributions')
+    if independent_expenditures is not None:
+        n = ingest_independent_expenditures(conn, independent_expenditures, cycle, load_date, min_amount)
+        logging.info(f'Loaded {n} independent expenditures')
+    conn.executescript(indexes)
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+
+class BulkStore:
+    """
+    Answers the fec_api queries from a local bulk data store, returning rows shaped like the API's
+    """
+
+    def __init__(self, path):
+        self.conn = connect(path)
+        self.conn.executescript(indexes)
+        self.lock = threading.Lock()
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def iter_query(self, sql, params=(), batch_size=100):
+        """
+        Stream rows in batches so callers can stop early, sharing the connection between threads
+        """
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+
+    def get_committee(self, committee_id, cycle=None):
+        rows = self.query('SELECT * FROM committees WHERE committee_id = ?', (committee_id,))
+        if len(rows) == 0:
+            return None
+        row = rows[0]
+        sponsor_candidate_ids = [row['candidate_id']] if row['candidate_id'] is not None else None
+        return {
+            'committee_id': row['committee_id'],
+            'name': row['name'],
+            'designation': row['designation'],
+            'committee_type': row['committee_type'],
+            'party_full': parties.get(row['party'], row['party'] or None),
+            'state': row['state'],
+            'sponsor_candidate_ids': sponsor_candidate_ids,
+            'candidate_ids': sponsor_candidate_ids or [],
+            'website': None,  # not in the bulk files
+            'cycle': cycle
+        }
+
+    def get_row_committee(self, committee_id, name=None):
+        """
+        Get the committee of a filing, with every key the API returns even when the committee master file
+        doesn't list it
+        :param committee_id: committee id of the filing
+        :param name: committee name from the filing, used when the committee isn't listed
+        :return: committee dictionary
+        """
+        committee = self.get_committee(committee_id)
+        if committee is None:
+            committee = {
+                'committee_id': committee_id,
+                'name': name,
+                'designation': None,
+                'committee_type': None,
+                'party_full': None,
+                'state': None,
+                'sponsor_candidate_ids': None,
+                'candidate_ids': [],
+                'website': None,
+                'cycle': None
+            }
+        return committee
+
+    def format_candidate(self, row):
+        name = parse_name(row['name'])
+        return {
+            'candidate_id': row['candidate_id'],
+            'name': row['name'],
+            'first_name': name.first,
+            'last_name': name.last,
+            'party_full': parties.get(row['party'], row['party'] or None),
+            'state': row['state'],
+            'office': row['office'],
+            'office_full': offices.get(row['office']),
+            'district': row['district'],
+            'election_year': row['election_year']
+        }
+
+    def get_candidates(self, candidate_id=None, name=None, state=None, **kwargs):
+        clauses = []
+        params = []
+        if candidate_id is not None:
+            candidate_ids = candidate_id if isinstance(candidate_id, (list, tuple)) else [candidate_id]
+            clauses.append(f'candidate_id IN ({", ".join("?" * len(candidate_ids))})')
+            params += candidate_ids
+        if name is not None:
+            for token in name.replace(',', ' ').split():
+                clauses.append('name LIKE ?')
+                params.append(f'%{token}%')
+        if state is not None:
+            clauses.append('state = ?')
+            params.append(state)
+        where = ' AND '.join(clauses) or '1'
+        rows = self.query(f'SELECT * FROM candidates WHERE {where} ORDER BY election_year DESC', params)
+        return [self.format_candidate(row) for row in rows]
+
+    def iter_schedule_a(self, min_load_date=None, max_load_date=None, min_amount=None, committee_id=None,
+                        contributor_type=None, two_year_transaction_period=None, **kwargs):
+        if committee_id is not None:
+            # Load dates here are when the mirror was filled, not when the FEC loaded the filing, so date
+            # windows meant for the API would drop a committee's history. The mirror only holds the cycles
+            # that were loaded into it, so the API's cycle doesn't apply either.
+            min_load_date = max_load_date = two_year_transaction_period = None
+        clauses = []
+        params = []
+        for clause, value in (('load_date >= ?', min_load_date), ('load_date <= ?', max_load_date),
+                              ('amount >= ?', min_amount), ('committee_id = ?', committee_id),
+                              ('cycle = ?', two_year_transaction_period)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        if contributor_type == 'individual':
+            clauses.append("entity_type = 'IND'")
+        elif contributor_type == 'committee':
+            clauses.append("entity_type != 'IND'")
+        where = ' AND '.join(clauses) or '1'
+        rows = self.iter_query(f'SELECT * FROM schedule_a WHERE {where} ORDER BY load_date', params)
+        for row in rows:
+            yield self.format_schedule_a(row)
+
+    def format_schedule_a(self, row):
+        name = parse_name(row['name'])
+        return {
+            'transaction_id': row['transaction_id'],
+            'sub_id': row['sub_id'],
+            'committee_id': row['committee_id'],
+            'committee': self.get_row_committee(row['committee_id']),
+            'entity_type': row['entity_type'],
+            'contributor_name': row['name'],
+            'contributor_first_name': name.first or None,
+            'contributor_middle_name': name.middle or None,
+            'contributor_last_name': name.last or None,
+            'contributor_city': row['city'],
+            'contributor_state': row['state'],
+            'contributor_employer': row['employer'],
+            'contributor_occupation': row['occupation'],
+            'contributor': {'committee_id': row['other_id']} if row['other_id'] is not None else None,
+            'contribution_receipt_date': row['date'],
+            'contribution_receipt_amount': row['amount'],
+            'pdf_url': pdf_url_template.format(image_num=row['image_num']),
+            'two_year_transaction_period': row['cycle'],
+            'load_date': row['load_date']
+        }
+
+    def iter_schedule_e(self, min_load_date=None, min_filing_date=None, min_amount=None,
+                        min_dissemination_date=None, candidate_id=None, committee_id=None, **kwargs):
+        if committee_id is not None:
+            # See iter_schedule_a
+            min_load_date = None
+        clauses = []
+        params = []
+        for clause, value in (('load_date >= ?', min_load_date), ('filing_date >= ?', min_filing_date),
+                              ('amount >= ?', min_amount), ('dissemination_date >= ?', min_dissemination_date),
+                              ('candidate_id = ?', candidate_id), ('committee_id = ?', committee_id)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        where = ' AND '.join(clauses) or '1'
+        rows = self.iter_query(f'SELECT * FROM schedule_e WHERE {where} ORDER BY load_date', params)
+        for row in rows:
+            yield self.format_schedule_e(row)
+
+    def format_schedule_e(self, row):
+        name = parse_name(row['candidate_name'])
+        return {
+            'transaction_id': row['transaction_id'],
+            'committee_id': row['committee_id'],
+            'committee': self.get_row_committee(row['committee_id'], row['committee_name']),
+            'candidate_id': row['candidate_id'],
+            'candidate_name': row['candidate_name'],
+            'candidate_first_name': name.first or None,
+            'candidate_last_name': name.last or None,
+            'candidate_office': row['candidate_office'],
+            'candidate_office_state': row['candidate_office_state'],
+            'expenditure_amount': row['amount'],
+            'expenditure_date': row['expenditure_date'],
+            'dissemination_date': row['dissemination_date'],
+            'filing_date': row['filing_date'],
+            'support_oppose_indicator': row['support_oppose'],
+            'expenditure_description': row['purpose'],
+            'payee_name': row['payee'],
+            'pdf_url': pdf_url_template.format(image_num=row['image_num']),
+            'load_date': row['load_date']
+        }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s: %(message)s', stream=sys.stdout, level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Load FEC bulk data files into a local store')
+    parser.add_argument("--db", default='fec_bulk.sqlite')
+    parser.add_argument("--cycle", type=int, required=True)
+    parser.add_argument("--committees", help="committee master file, cm.txt")
+    parser.add_argument("--candidates", help="candidate master file, cn.txt")
+    parser.add_argument("--contributions", help="individual contributions file, itcont.txt")
+    parser.add_argument("--independent_expenditures", help="independent_expenditure_YYYY.csv")
+    parser.add_argument("--min_amount", type=float, default=0)
+    parser.add_argument("--load_date", help="date to stamp new rows with, defaults to now")
+    args = vars(parser.parse_args())
+    ingest(
+        args['db'],
+        args['cycle'],
+        committees=args['committees'],
+        candidates=args['candidates'],
+        contributions=args['contributions'],
+        independent_expenditures=args['independent_expenditures'],
+        min_amount=args['min_amount'],
+        load_date=args['load_date']
+    )
@@ -1,16 +1,10 @@
 from fec_api import get_schedule_a
 from math import log
-import locale
-import requests
+import http_client
+import metrics
 from collections.abc import Iterable
-from svglib.svglib import svg2rlg
-from reportlab.graphics import renderPM
-from PIL import Image, ImageFont, ImageDraw, ImageOps
 from io import BytesIO
-
-all_committees = []
-
-locale.setlocale(locale.LC_ALL, 'en_CA.UTF-8')
+from text_format import format_amount
 
 
 class Committee:
@@ -72,7 +66,14 @@ class Candidate:
         return display.strip()
 
 
-def agg_by_funder(schedule_as, calling_committee):
+def agg_by_funder(schedule_as, calling_committee, crawled):
+    """
+    Group a committee's receipts by funder, crawling the funders of committees that haven't been crawled yet
+    :param schedule_as: schedule a rows of the committee
+    :param calling_committee: Committee receiving the money
+    :param crawled: Committees already crawled for this chart
+    :return: list of funders
+    """
     funders = []
     for schedule_a in schedule_as:
         if schedule_a['entity_type'] == 'IND':
@@ -99,7 +100,7 @@ def agg_by_funder(schedule_as, calling_committee):
                                        committee_id=None)
 
                 # Check if we've already built out a tree for this committee, do nothing if we have
-                matched = [co for co in all_committees if co.match(funder.committee_name)]
+                matched = [co for co in crawled if co.match(funder.committee_name)]
                 if len(matched) > 0:
                     pass
                 else:
@@ -109,7 +110,7 @@ def agg_by_funder(schedule_as, calling_committee):
                     if len(matched) > 0:
                         funder = matched[0]
                     else:
-                        funder = get_funders(funder)
+                        funder = get_funders(funder, crawled=crawled)
 
                 funders.append(funder)
 
@@ -118,7 +119,16 @@ def agg_by_funder(schedule_as, calling_committee):
     return funders
 
 
-def get_funders(committee, min_amount=1e5):
+def get_funders(committee, min_amount=1e5, crawled=None):
+    """
+    Crawl the committees funding a committee
+    :param committee: Committee
+    :param min_amount: smallest receipt to follow
+    :param crawled: Committees already crawled for this chart, starts a new crawl when None
+    :return: committee, with its funders filled in
+    """
+    if crawled is None:
+        crawled = []
     # Skip committees that have massive donor lists
     if committee.committee_id in ('C00694323', 'C00075820', 'C00401224') or committee.committee_id is None:
         return committee
@@ -131,8 +141,8 @@ def get_funders(committee, min_amount=1e5):
         committee_id=committee.committee_id
     )
 
-    all_committees.append(committee)
-    committee.funders = agg_by_funder(schedule_as, committee)
+    crawled.append(committee)
+    committee.funders = agg_by_funder(schedule_as, committee, crawled)
     return committee
 
 
@@ -149,7 +159,7 @@ def gen_edges(obj, min_amount_direct, min_amount_indirect):
         # heuristic for determining line weight
         10 * (log(1e6) - log(1e6)) / 4.8
         weight = max(10 * (log(funder.amount) - log(1e6)) / 4.8, 0.5)
-        amount = format_amount(funder.amount)
+        amount = format_amount(funder.amount, thousands=True)
         if hasattr(funder, 'support_oppose'):
             if funder.support_oppose == 'support':
                 edge = f""""{giver}" -> "{getter}" [label = "{amount}", color=forestgreen, penwidth={weight}]"""
@@ -181,20 +191,6 @@ def gen_nodes(obj, min_amount_direct, min_amount_indirect):
     return nodes
 
 
-def format_amount(amount):
-    amount = round(amount)
-    if amount >= 1e6:
-        end = 'M'
-        amount = round(amount / 1e6, 1)
-    elif amount >= 1e5:
-        end = 'K'
-        amount = round(amount / 1e3, 1)
-    else:
-        end = ''
-
-    return locale.currency(amount, grouping=True).rstrip('0').rstrip('.') + end
-
-
 def extract_amounts(funders, direct_only):
     amounts = []
     for funder in funders:
@@ -215,6 +211,10 @@ def flatten(xs):
 
 
 def generate_graphviz_via_api(nodes, edges, upper, lower):
+    # Rendering libraries are slow to import, so only load them when a chart is drawn
+    from svglib.svglib import svg2rlg
+    from reportlab.graphics import renderPM
+    from PIL import Image, ImageFont, ImageDraw, ImageOps
     template = """digraph penn_oz {{
 graph [pad="0.1", nodesep="0", ranksep="0"];
 
@@ -234,32 +234,31 @@ imagescale=15;
         nodes='\n'.join(nodes),
         edges='\n'.join(edges),
     )
-    r = requests.post('https://quickchart.io/graphviz', json={'graph': graph, 'format': 'svg'})
-    filename_base = './tmp_img'
-    with open(filename_base + '.svg', 'wb') as f:
-        f.write(r.content)
-    drawing = svg2rlg(filename_base + '.svg')
-    renderPM.drawToFile(drawing, filename_base + '.png')
-
-    img = Image.open(filename_base + '.png')
+    r = http_client.post('https://quickchart.io/graphviz', json={'graph': graph, 'format': 'svg'})
+    # Render in memory so concurrent charts don't share temporary files
+    drawing = svg2rlg(BytesIO(r.content))
+    img = Image.open(BytesIO(renderPM.drawToString(drawing, fmt='PNG')))
     padding = img.height // 4 + 25
     img = ImageOps.expand(img, border=padding, fill='white')
     draw = ImageDraw.Draw(img)
     draw.fontmode = 'L'
-    req = requests.get("https://github.com/googlefonts/roboto/blob/main/src/hinted/Roboto-Regular.ttf?raw=true")
+    req = http_client.get("https://github.com/googlefonts/roboto/blob/main/src/hinted/Roboto-Regular.ttf?raw=true")
     font_size = round(1.35 * (img.width - 2 * padding) / len(upper))
     font = ImageFont.truetype(BytesIO(req.content), font_size)
 
     draw.text((padding + 30, 10), upper + '\n' + lower, fill='black', font=font)
     img = img.crop((padding, 0, img.width-padding, img.height-padding))
-    img.save(filename_base + '.png')
-    return filename_base + '.png'
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+    buffer.seek(0)
+    return buffer
 
 
 def generate_committee_chart(committee_name, committee_id, support_oppose, spend_amount, candidate_name, n_direct=10, n_indirect=15):
     candidate = Candidate(candidate_name)
     committee = Committee(committee_name=committee_name, committee_id=committee_id)
-    committee = get_funders(committee)
+    with metrics.span('chart', stage='crawl'):
+        committee = get_funders(committee)
     committee.support_oppose = support_oppose
     candidate.funders = [committee]
     committee.amount = spend_amount
@@ -293,6 +292,7 @@ def generate_committee_chart(committee_name, committee_id, support_oppose, spend
     if len(nodes) <= 4:
         # Do no post really simple funding charts
         return
-    formated_amount = format_amount(spend_amount)
-    filename = generate_graphviz_via_api(nodes, edges, upper=f'Where did {committee.committee_name} get {formated_amount}', lower=f'to {support_oppose} {candidate.candidate_name}?')
-    return filename
+    formated_amount = format_amount(spend_amount, thousands=True)
+    with metrics.span('chart', stage='render'):
+        chart = generate_graphviz_via_api(nodes, edges, upper=f'Where did {committee.committee_name} get {formated_amount}', lower=f'to {support_oppose} {candidate.candidate_name}?')
+    return chart
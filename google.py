@@ -1,5 +1,4 @@
-import requests
-from credentials import google_api_key
+import http_client
 
 
 def api_get(endpoint, params):
@@ -9,6 +8,7 @@ def api_get(endpoint, params):
     :param params: a dictionary of parameters
     :return: a json dictionary returned by the API
     """
+    from credentials import google_api_key
     params = {
         **params,
         **{
@@ -16,7 +16,7 @@ def api_get(endpoint, params):
         }
     }
 
-    response = requests.get(endpoint, params)
+    response = http_client.get(endpoint, params)
     if response.status_code != 200:
         raise Exception('API error: ' + response.text)
         return response.json()
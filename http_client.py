@@ -0,0 +1,184 @@
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+# Shared connection settings, can be changed with configure()
+settings = {
+    'connect_timeout': 5,
+    'read_timeout': 30,
+    'max_retries': 3,
+    'backoff_base': 0.5,
+    'backoff_cap': 30,
+    'pool_connections': 16,
+    'pool_maxsize': 16,
+    'user_agent': 'Mozilla/5.0 (compatible; darkmoneybot)'
+}
+
+retry_statuses = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+# Sends requests instead of the session when set, e.g. to record or replay responses, see set_transport
+_transport = None
+# Bounds outbound calls in flight across threads when set, see set_concurrency
+_limiter = None
+_limiter_local = threading.local()
+
+
+def configure(**kwargs):
+    """
+    Update shared client settings. Pool settings take effect on the next session created.
+    :param kwargs: any key of settings
+    """
+    for key, value in kwargs.items():
+        if key not in settings:
+            raise KeyError(f'Unknown http client setting: {key}')
+        settings[key] = value
+
+
+def get_session():
+    """
+    Get the process-wide session. Each host gets its own keep-alive connection pool.
+    :return: a requests session
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=settings['pool_connections'],
+                    pool_maxsize=settings['pool_maxsize']
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers['User-Agent'] = settings['user_agent']
+                _session = session
+    return _session
+
+
+def close():
+    """
+    Close the shared session and all of its pooled connections
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def set_transport(transport):
+    """
+    Send every request through another object with the session's request(method, url, **kwargs) signature
+    :param transport: transport to use, None to go back to the shared session
+    """
+    global _transport
+    _transport = transport
+
+
+def set_concurrency(limit):
+    """
+    Bound the number of outbound calls in flight at once, counting requests made here and SDK calls made
+    through replay.call
+    :param limit: most calls at once, None for no bound
+    """
+    global _limiter
+    _limiter = threading.BoundedSemaphore(limit) if limit is not None else None
+
+
+@contextmanager
+def outbound():
+    """
+    Hold one of the concurrency slots for the length of a with block. Nested blocks on the same thread
+    share the slot.
+    """
+    limiter = _limiter
+    depth = getattr(_limiter_local, 'depth', 0)
+    if limiter is None or depth > 0:
+        _limiter_local.depth = depth + 1
+        try:
+            yield
+        finally:
+            _limiter_local.depth = depth
+        return
+    with limiter:
+        _limiter_local.depth = 1
+        try:
+            yield
+        finally:
+            _limiter_local.depth = 0
+
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Jittered exponential backoff, honouring a Retry-After header when the server sends one
+    :param attempt: zero based attempt number
+    :param retry_after: value of the Retry-After header
+    :return: seconds to wait
+    """
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), settings['backoff_cap'])
+        except ValueError:
+            pass
+    ceiling = min(settings['backoff_cap'], settings['backoff_base'] * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+
+def request(method, url, timeout=None, retries=None, **kwargs):
+    """
+    Make a request on the shared session with timeouts and retries on 429/5xx and connection errors
+    :param method: HTTP method
+    :param url: URL to request
+    :param timeout: (connect, read) tuple, defaults to the configured timeouts
+    :param retries: number of retries, defaults to the configured max_retries
+    :param kwargs: passed through to requests
+    :return: response
+    """
+    if timeout is None:
+        timeout = (settings['connect_timeout'], settings['read_timeout'])
+    if retries is None:
+        retries = settings['max_retries']
+
+    session = _transport if _transport is not None else get_session()
+    host = urlsplit(url).hostname
+    attempt = 0
+    while True:
+        if attempt > 0:
+            metrics.count('http_retries', host=host)
+        try:
+            with outbound(), metrics.span('http', host=host):
+                response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            metrics.count('http_errors', host=host, error=type(error).__name__)
+            if attempt >= retries:
+                raise
+            delay = backoff_delay(attempt)
+            logging.info(f'{method} {url} failed ({error}), retrying in {delay:.1f}s')
+        else:
+            metrics.count('http_requests', host=host, status=response.status_code)
+            # Streamed bodies may be read only in part, callers reading them count the bytes they read
+            if not kwargs.get('stream'):
+                metrics.count('http_bytes', len(response.content), host=host)
+            if response.status_code not in retry_statuses or attempt >= retries:
+                return response
+            delay = backoff_delay(attempt, response.headers.get('Retry-After'))
+            logging.info(f'{method} {url} returned {response.status_code}, retrying in {delay:.1f}s')
+            response.close()
+        time.sleep(delay)
+        attempt += 1
+
+
+def get(url, params=None, **kwargs):
+    return request('GET', url, params=params, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
@@ -0,0 +1,69 @@
+import hashlib
+import threading
+import http_client
+from cache import Cache
+
+# Images get their own store so they can't push API lookups out of the main cache
+default_path = 'image_cache.sqlite'
+max_bytes = 200e6
+
+# Seconds to trust a person's image URL, and how long to remember that a person has no image
+person_ttl = 30 * 24 * 60 * 60
+negative_ttl = 24 * 60 * 60
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_image_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = Cache(default_path, max_bytes=max_bytes, memo_size=32)
+    return _cache
+
+
+def get_person_image_url(name, resolve):
+    """
+    Get the image URL for a person, remembering people with no image too
+    :param name: name of the person
+    :param resolve: function that finds the image URL for a name, returning None if there isn't one
+    :return: URL or None
+    """
+    cache = get_image_cache()
+    url = cache.get('person', name)
+    if url is None:
+        url = resolve(name)
+        cache.set('person', name, url or '', ttl=person_ttl if url else negative_ttl)
+    return url or None
+
+
+def get_image(url, variant=None, process=None):
+    """
+    Get image bytes by URL, downloading only on a miss. Images are stored once per content hash, along with
+    processed variants of them.
+    :param url: source URL
+    :param variant: name of a processed variant, e.g. 'padded'
+    :param process: function taking and returning image bytes, used to make the variant on a miss
+    :return: image bytes
+    """
+    cache = get_image_cache()
+    digest = cache.get('url', url)
+    original = cache.get('blob', digest) if digest is not None else None
+    if original is None:
+        response = http_client.get(url)
+        response.raise_for_status()
+        original = response.content
+        digest = hashlib.sha256(original).hexdigest()
+        cache.set('blob', digest, original)
+        cache.set('url', url, digest)
+
+    if variant is None:
+        return original
+
+    processed = cache.get('variant', f'{digest}:{variant}')
+    if processed is None:
+        processed = process(original)
+        cache.set('variant', f'{digest}:{variant}', processed)
+    return processed
@@ -0,0 +1,54 @@
+import sys
+import json
+import argparse
+import logging
+import subprocess
+
+# Modules that should only be imported once they are needed, never by importing main
+deferred_modules = ('openai', 'tweepy', 'PIL', 'svglib', 'reportlab', 'titlecase', 'nameparser', 'bs4', 'credentials')
+
+probe = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'loaded': [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+
+def measure(module='main', repeat=5):
+    """
+    Time importing a module in fresh interpreters
+    :param module: module to import
+    :param repeat: number of interpreters to start, the fastest is reported
+    :return: (seconds, list of deferred modules the import loaded)
+    """
+    results = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', probe.format(module=module, deferred=deferred_modules)],
+            capture_output=True, text=True, check=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    fastest = min(results, key=lambda result: result['seconds'])
+    return fastest['seconds'], fastest['loaded']
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s: %(message)s', stream=sys.stdout, level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Check that importing the bot is fast and side effect free')
+    parser.add_argument("--module", default='main')
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=0.5, help="most seconds the import may take")
+    args = vars(parser.parse_args())
+
+    seconds, loaded = measure(args['module'], args['repeat'])
+    logging.info(f'Importing {args["module"]} took {seconds * 1000:.0f}ms')
+    failed = False
+    if len(loaded) > 0:
+        logging.info(f'Imported modules that should be deferred: {", ".join(loaded)}')
+        failed = True
+    if seconds > args['budget']:
+        logging.info(f'Over the {args["budget"] * 1000:.0f}ms budget')
+        failed = True
+    sys.exit(1 if failed else 0)
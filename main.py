@@ -1,80 +1,389 @@
-import csv
+import os
 import sys
+import time
+import fcntl
+import signal
+import tempfile
+import threading
+import asyncio
 import argparse
 import logging
 from datetime import datetime, timedelta
-from twitter import fetch_schedule_a_data_and_build_tweets, fetch_schedule_e_data_and_build_tweets, TweetStatus
+import fec_api
+import build_graph
+import http_client
+import metrics
+import replay
+from dedup_store import get_dedup_store, read_handled
+from outbox import get_outbox, PostingScheduler
+from twitter_client import get_twitter_clients
+from twitter import fetch_schedule_a_data_and_build_tweets, fetch_schedule_e_data_and_build_tweets, TweetStatus, \
+    make_async_builder, build_tweet, gen_reply_tweet
 
 
 logging.basicConfig(format='%(asctime)s: %(message)s', stream=sys.stdout, level=logging.INFO)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--run_level", type=int)
-    args = vars(parser.parse_args())
-    run_level = args['run_level']
+POST_CAP = 2
+BUILD_WORKERS = 2
+POST_MAX_WAIT = 900
+POLL_INTERVAL = 600
 
-    logging.info(f'Run level: {run_level}')
-    min_load_date = datetime.now() - timedelta(days=7)
-    min_dis_date = datetime.now() - timedelta(days=7)
-    min_file_date = datetime.now() - timedelta(days=7)
+# Set when a daemon is asked to stop
+shutdown = threading.Event()
+_scheduler = None
+
+# Which schedules this worker fetches, its share of their transactions, and where it writes run reports,
+# see configure_worker
+worker = {
+    'name': 'darkmoneybot',
+    'schedules': ('a', 'e'),
+    'shard': None,
+    'report_dir': None
+}
+
+
+def configure_worker(schedules=('a', 'e'), shard=None, report_dir=None):
+    """
+    Set up this process as one of several workers sharing the dedup store and outbox. Each shard keeps its
+    own fetch checkpoints, as every shard pages through the same rows.
+    :param schedules: schedules to fetch, 'a' and/or 'e'
+    :param shard: (index, count) to only build this worker's share of transactions, None for all of them
+    :param report_dir: directory to write run reports to, None to not write them
+    """
+    worker['schedules'] = tuple(schedules)
+    worker['shard'] = shard
+    worker['report_dir'] = report_dir
+    worker['name'] = 'darkmoneybot'
+    if worker['schedules'] != ('a', 'e'):
+        worker['name'] += '-' + ''.join(worker['schedules'])
+    if shard is not None:
+        worker['name'] += f'-{shard[0]}-of-{shard[1]}'
+        fec_api.checkpoint_file = f'checkpoints-{shard[0]}-of-{shard[1]}.json'
 
-    total_posts = 0
-    POST_CAP = 2
 
-    transactions = []
-    with open('transactions.csv', 'r') as csv_file:
-        reader_obj = csv.reader(csv_file)
-        # Iterate over each row in the csv
-        # file using reader object
-        for row in reader_obj:
-            transactions.append(row[0])
+def write_run_report():
+    """
+    Log the slowest spans and write the run's metrics as a JSON report and a Prometheus textfile, named after
+    the worker, then start counting afresh for the next run
+    """
+    run_metrics = metrics.get_metrics()
+    run_metrics.log_summary()
+    if worker['report_dir'] is not None:
+        run_metrics.write(
+            json_path=os.path.join(worker['report_dir'], f'{worker["name"]}-report.json'),
+            prometheus_path=os.path.join(worker['report_dir'], f'{worker["name"]}.prom')
+        )
+    run_metrics.reset()
 
-    tweets_a = fetch_schedule_a_data_and_build_tweets(
+
+def parse_shard(text):
+    """
+    :param text: shard as INDEX/COUNT, e.g. 0/4
+    :return: (index, count)
+    """
+    index, count = (int(part) for part in text.split('/'))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'Shard index must be from 0 to {count - 1}')
+    return index, count
+
+
+def fetch_a(transactions, builder=build_tweet, incremental=True, workers=BUILD_WORKERS):
+    if 'a' not in worker['schedules']:
+        return []
+    min_load_date = datetime.now() - timedelta(days=7)
+    return fetch_schedule_a_data_and_build_tweets(
        min_load_date=min_load_date.strftime('%Y-%m-%d'),
        min_amount=1e5,
        contributor_type='individual',
        transactions=transactions,
-       post_cap=POST_CAP
+       post_cap=POST_CAP,
+       builder=builder,
+       incremental=incremental,
+       workers=workers,
+       shard=worker['shard']
     )
 
-    for tweet in tweets_a:
-        if tweet.status == TweetStatus.PENDING:
-            try:
-                tweet.post(run_level=run_level)
-            except Exception as error:
-                logging.info(error)
-        else:
-            logging.info(f'Skipping {tweet.transaction_id} because {tweet.build_issues}')
-            with open('transactions.csv', 'a') as csv_file:
-                writer_object = csv.writer(csv_file)
-                writer_object.writerow([tweet.transaction_id])
 
-    tweets_e = fetch_schedule_e_data_and_build_tweets(
+def fetch_e(transactions, builder=build_tweet, incremental=True, workers=BUILD_WORKERS):
+    if 'e' not in worker['schedules']:
+        return []
+    min_load_date = datetime.now() - timedelta(days=7)
+    min_dis_date = datetime.now() - timedelta(days=7)
+    min_file_date = datetime.now() - timedelta(days=7)
+    return fetch_schedule_e_data_and_build_tweets(
         min_filing_date=min_file_date.strftime('%Y-%m-%d'),
         min_load_date=min_load_date.strftime('%Y-%m-%d'),
         min_dissemination_date=min_dis_date.strftime('%Y-%m-%d'),
         min_amount=5e4,
         transactions=transactions,
-        post_cap=POST_CAP
+        post_cap=POST_CAP,
+        builder=builder,
+        incremental=incremental,
+        workers=workers,
+        shard=worker['shard']
     )
 
-    for tweet in tweets_e:
+
+def get_scheduler():
+    """
+    Get the posting scheduler, kept between daemon cycles so post spacing carries over
+    :return: PostingScheduler
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = PostingScheduler(get_outbox(), get_twitter_clients(), stop=shutdown)
+    return _scheduler
+
+
+def post_tweets(tweets, run_level):
+    """
+    Queue built tweets in the outbox, or log them when not posting
+    :param tweets: list of Tweet
+    :param run_level: 1 to post
+    """
+    for tweet in tweets:
         if tweet.status == TweetStatus.PENDING:
-            try:
+            if run_level == 1:
+                tweet.outbox_id = get_outbox().enqueue(tweet)
+            else:
                 tweet.post(run_level=run_level)
-            except Exception as error:
-                logging.info(error)
+                # Nothing was posted, so later runs may build it again
+                get_dedup_store().release(tweet.transaction_id)
         else:
             logging.info(f'Skipping {tweet.transaction_id} because {tweet.build_issues}')
-            with open('transactions.csv', 'a') as csv_file:
-                writer_object = csv.writer(csv_file)
-                writer_object.writerow([tweet.transaction_id])
+            for issue in tweet.build_issues:
+                # Drop the variable part of messages like "Unknown error: ..." to keep the reasons countable
+                metrics.count('blocked', reason=issue.split(':')[0])
+            get_dedup_store().add(tweet.transaction_id)
+
+
+def post_replies(run_level):
+    """
+    Build and queue replies to posted tweets. Reply requests are kept in the outbox, so tweets posted by an
+    earlier run, or by another worker, get their replies too.
+    :param run_level: 1 to post
+    """
+    if run_level != 1:
+        return
+    outbox = get_outbox()
+    while True:
+        taken = outbox.take_reply()
+        if taken is None:
+            break
+        entry, request = taken
+        reply_tweet = gen_reply_tweet(request, entry['tweet_id'])
+        if reply_tweet.status == TweetStatus.PENDING:
+            outbox.enqueue(reply_tweet, parent_id=entry['id'])
+
+
+def drain_outbox(run_level, max_wait=POST_MAX_WAIT):
+    if run_level == 1:
+        n_posted = get_scheduler().drain(max_wait=max_wait)
+        logging.info(f'Posted {n_posted} tweets from the outbox')
 
-    for tweet in tweets_e:
-        if tweet.status == TweetStatus.POSTED:
-            reply_tweet = tweet.gen_reply_tweet()
-            if reply_tweet.status == TweetStatus.PENDING:
-                reply_tweet.post(run_level=run_level)
 
+def run(run_level, incremental=True, workers=BUILD_WORKERS, max_wait=POST_MAX_WAIT):
+    transactions = get_dedup_store()
+
+    tweets_a = fetch_a(transactions, incremental=incremental, workers=workers)
+    post_tweets(tweets_a, run_level)
+
+    tweets_e = fetch_e(transactions, incremental=incremental, workers=workers)
+    post_tweets(tweets_e, run_level)
+    drain_outbox(run_level, max_wait)
+
+    post_replies(run_level)
+    drain_outbox(run_level, max_wait)
+    transactions.flush()
+
+
+async def run_async(run_level, concurrency, incremental=True, workers=BUILD_WORKERS, max_wait=POST_MAX_WAIT):
+    """
+    Fetch and build both schedules at the same time, prefetching each tweet's lookups concurrently.
+    Posting keeps the same order as a sequential run.
+    :param run_level: 1 to post
+    :param concurrency: maximum number of network calls in flight, counting prefetched lookups, the calls build
+    steps make and posts
+    :param incremental: resume from the fetch checkpoints rather than re-reading the whole window
+    :param workers: number of tweets to build at once per schedule
+    :param max_wait: most seconds to wait for the posting rate limit before leaving tweets queued
+    """
+    transactions = get_dedup_store()
+    limiter = asyncio.Semaphore(concurrency)
+    builder = make_async_builder(asyncio.get_running_loop(), limiter)
+    http_client.set_concurrency(concurrency)
+    try:
+        tweets_a, tweets_e = await asyncio.gather(
+            asyncio.to_thread(fetch_a, transactions, builder, incremental, workers),
+            asyncio.to_thread(fetch_e, transactions, builder, incremental, workers)
+        )
+
+        post_tweets(tweets_a, run_level)
+        post_tweets(tweets_e, run_level)
+        await asyncio.to_thread(drain_outbox, run_level, max_wait)
+
+        post_replies(run_level)
+        await asyncio.to_thread(drain_outbox, run_level, max_wait)
+        transactions.flush()
+    finally:
+        http_client.set_concurrency(None)
+
+
+def run_daemon(run_level, interval=POLL_INTERVAL, use_async=False, concurrency=8, incremental=True,
+               workers=BUILD_WORKERS, max_wait=POST_MAX_WAIT):
+    """
+    Run a cycle every interval seconds until SIGTERM or SIGINT. HTTP pools, caches, the dedup store and the
+    Twitter clients are process-wide, so they stay warm between cycles and each cycle only pays for new data.
+    A signal lets the current cycle finish, apart from waiting on the posting rate limit.
+    :param run_level: 1 to post
+    :param interval: seconds from the start of one cycle to the start of the next
+    :param use_async: run each cycle with run_async
+    :param concurrency: maximum number of network calls in flight in async mode
+    :param incremental: resume from the fetch checkpoints rather than re-reading the whole window
+    :param workers: number of tweets to build at once per schedule
+    :param max_wait: most seconds to wait for the posting rate limit before leaving tweets queued
+    """
+    def stop(signum, frame):
+        logging.info(f'Received signal {signum}, stopping after this cycle')
+        shutdown.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    cycle = 0
+    while not shutdown.is_set():
+        cycle += 1
+        start = time.monotonic()
+        logging.info(f'Starting cycle {cycle}')
+        try:
+            if use_async:
+                asyncio.run(run_async(run_level, concurrency, incremental=incremental, workers=workers,
+                                      max_wait=max_wait))
+            else:
+                run(run_level, incremental=incremental, workers=workers, max_wait=max_wait)
+        except Exception as error:
+            # Keep polling, the next cycle resumes from the last checkpoint
+            logging.exception(f'Cycle {cycle} failed: {error}')
+        write_run_report()
+        elapsed = time.monotonic() - start
+        logging.info(f'Cycle {cycle} took {elapsed:.1f}s')
+        shutdown.wait(max(interval - elapsed, 0))
+
+    get_dedup_store().close()
+    http_client.close()
+    logging.info('Daemon stopped')
+
+
+def acquire_run_lock(name='darkmoneybot'):
+    """
+    Stop overlapping runs, e.g. when a cron run takes longer than its interval
+    :param name: name of the lock, workers doing different work take different locks
+    :return: the locked file, which must stay open for the lock to be held
+    """
+    lock_file = open(f'{name}.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--run_level", type=int)
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="overlap fetches and run independent lookups concurrently")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="maximum concurrent network calls in async mode, including SDK calls")
+    parser.add_argument("--full_window", action="store_true",
+                        help="ignore fetch checkpoints and re-read the whole 7 day window")
+    parser.add_argument("--workers", type=int, default=BUILD_WORKERS,
+                        help="number of tweets to build at once per schedule")
+    parser.add_argument("--max_post_wait", type=int, default=POST_MAX_WAIT,
+                        help="most seconds to wait for the posting rate limit, queued tweets are kept for the next run")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running, polling for new filings every --interval seconds")
+    parser.add_argument("--interval", type=int, default=POLL_INTERVAL, help="seconds between polls in daemon mode")
+    parser.add_argument("--schedules", default='ae', choices=['a', 'e', 'ae'],
+                        help="schedules this worker fetches, to run one worker per schedule")
+    parser.add_argument("--shard", type=parse_shard,
+                        help="INDEX/COUNT, build only this worker's share of transactions, e.g. 0/4")
+    parser.add_argument("--report_dir", default='.',
+                        help="directory for the JSON run report and Prometheus textfile, e.g. node_exporter's")
+    parser.add_argument("--no_report", action="store_true", help="don't write run reports")
+    parser.add_argument("--record", metavar="ARCHIVE",
+                        help="record every external response to a gzipped fixture archive, with run level 1 "
+                             "posting through the outbox but never to Twitter")
+    parser.add_argument("--replay", metavar="ARCHIVE",
+                        help="serve every external response from a fixture archive, making no network calls")
+    parser.add_argument("--replay_latency",
+                        help="seconds to delay replayed responses, e.g. 0.05,api.open.fec.gov=0.3,openai=1.5")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for recording and replaying")
+    parser.add_argument("--bulk_mirror", help="query a local FEC bulk data store built with fec_bulk.py")
+    args = vars(parser.parse_args())
+    run_level = args['run_level']
+
+    logging.info(f'Run level: {run_level}')
+
+    report_dir = None if args['no_report'] else os.path.abspath(args['report_dir'])
+    configure_worker(args['schedules'], args['shard'], report_dir)
+
+    recorder = None
+    if args['record'] is not None or args['replay'] is not None:
+        mode = 'record' if args['record'] is not None else 'replay'
+        archive_path = os.path.abspath(args['record'] or args['replay'])
+        if args['bulk_mirror'] is not None:
+            args['bulk_mirror'] = os.path.abspath(args['bulk_mirror'])
+        # Transactions already handled by the live bot are skipped while recording, and the recording keeps
+        # them so replays skip the same ones
+        handled = read_handled() if mode == 'record' else None
+        # Start from empty caches, checkpoints and outbox, so recording captures every request and replays
+        # take the same path through the code
+        state_dir = tempfile.mkdtemp(prefix=f'darkmoneybot-{mode}-')
+        os.chdir(state_dir)
+        logging.info(f'Keeping state for this run in {state_dir}')
+        recorder = replay.install(mode, archive_path, latency=args['replay_latency'], seed=args['seed'])
+        # Calls are replayed in the order they were recorded and share one seeded random, so both runs build
+        # one tweet and one step at a time
+        if args['use_async'] or args['workers'] != 1:
+            logging.info(f'Building one tweet at a time to {mode} deterministically')
+        args['use_async'] = False
+        args['workers'] = 1
+        build_graph.step_workers = 1
+        if mode == 'record':
+            recorder.save_state('transactions', handled)
+        else:
+            handled = recorder.load_state('transactions', [])
+        get_dedup_store().import_ids(handled)
+        if mode == 'record' and run_level == 1:
+            logging.info('Recording with posts and media uploads stubbed, nothing is sent to Twitter')
+
+    run_lock = acquire_run_lock(worker['name'])
+    if run_lock is None:
+        logging.info('Another run is in progress, exiting')
+        sys.exit(0)
+
+    if args['bulk_mirror'] is not None:
+        fec_api.use_bulk_store(args['bulk_mirror'])
+
+    try:
+        if args['daemon']:
+            run_daemon(run_level, interval=args['interval'], use_async=args['use_async'],
+                       concurrency=args['concurrency'], incremental=not args['full_window'], workers=args['workers'],
+                       max_wait=args['max_post_wait'])
+        else:
+            try:
+                if args['use_async']:
+                    asyncio.run(run_async(run_level, args['concurrency'], incremental=not args['full_window'],
+                                          workers=args['workers'], max_wait=args['max_post_wait']))
+                else:
+                    run(run_level, incremental=not args['full_window'], workers=args['workers'],
+                        max_wait=args['max_post_wait'])
+            finally:
+                # Report failed runs too, they are the ones worth looking at
+                write_run_report()
+    finally:
+        if recorder is not None and recorder.mode == 'record':
+            recorder.archive.save()
     logging.info('Run complete')
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+
+prefix = 'darkmoneybot'
+# Longest label value kept, so free text like error messages can't blow up the number of series
+max_label_length = 80
+
+
+class Metrics:
+    """
+    Timings of named spans and counters, each split by labels, collected for the length of a run
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # (name, labels) to [count, total seconds, max seconds]
+        self.spans = {}
+        # (name, labels) to value
+        self.counters = {}
+
+    @staticmethod
+    def make_labels(labels):
+        return tuple(sorted((key, str(value)[:max_label_length]) for key, value in labels.items()))
+
+    def record(self, name, seconds, **labels):
+        """
+        Record one timing of a span
+        :param name: span name
+        :param seconds: time taken
+        :param labels: e.g. host='api.open.fec.gov'
+        """
+        key = (name, self.make_labels(labels))
+        with self.lock:
+            stats = self.spans.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def count(self, name, value=1, **labels):
+        """
+        Add to a counter
+        :param name: counter name
+        :param value: amount to add
+        :param labels: e.g. namespace='committee'
+        """
+        key = (name, self.make_labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def span(self, name, **labels):
+        """
+        Time the body of a with block, recording it even if it raises
+        :param name: span name
+        :param labels: e.g. step='build_amount'
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.spans.clear()
+            self.counters.clear()
+
+    def report(self):
+        """
+        :return: a JSON serializable dictionary of every span and counter
+        """
+        with self.lock:
+            spans = [
+                {'name': name, 'labels': dict(labels), 'count': count, 'seconds': total, 'max_seconds': longest}
+                for (name, labels), (count, total, longest) in self.spans.items()
+            ]
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in self.counters.items()
+            ]
+            started = self.started
+        spans.sort(key=lambda span: span['seconds'], reverse=True)
+        return {
+            'started': started,
+            'finished': time.time(),
+            'spans': spans,
+            'counters': counters
+        }
+
+    def prometheus(self):
+        """
+        :return: every span and counter in the Prometheus text exposition format
+        """
+        def series(name, labels):
+            if len(labels) == 0:
+                return name
+            text = ','.join(f'{key}="{escape(value)}"' for key, value in labels)
+            return f'{name}{{{text}}}'
+
+        lines = []
+        with self.lock:
+            span_metrics = [
+                ('span_count_total', 'counter', 0),
+                ('span_seconds_total', 'counter', 1),
+                ('span_seconds_max', 'gauge', 2)
+            ]
+            for metric, metric_type, i in span_metrics:
+                lines.append(f'# TYPE {prefix}_{metric} {metric_type}')
+                for (name, labels), stats in sorted(self.spans.items()):
+                    lines.append(f'{series(f"{prefix}_{metric}", (("span", name),) + labels)} {stats[i]}')
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE {prefix}_{name}_total counter')
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append(f'{series(f"{prefix}_{name}_total", labels)} {value}')
+            lines.append(f'# TYPE {prefix}_last_run_timestamp_seconds gauge')
+            lines.append(f'{prefix}_last_run_timestamp_seconds {time.time()}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path=None, prometheus_path=None):
+        """
+        Write the run report, replacing each file atomically so readers never see a partial one
+        :param json_path: where to write the JSON report, None to skip
+        :param prometheus_path: where to write the Prometheus textfile, e.g. for node_exporter, None to skip
+        """
+        for path, text in ((json_path, lambda: json.dumps(self.report(), indent=2)),
+                           (prometheus_path, self.prometheus)):
+            if path is None:
+                continue
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(text())
+            os.replace(tmp_path, path)
+
+    def log_summary(self, top=10):
+        """
+        Log the spans that took the most time in total
+        :param top: number of spans to log
+        """
+        for span in self.report()['spans'][:top]:
+            labels = ' '.join(f'{key}={value}' for key, value in span['labels'].items())
+            logging.info(f'{span["name"]} {labels}: {span["count"]} calls, {span["seconds"]:.2f}s total, '
+                         f'{span["max_seconds"]:.2f}s max')
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """
+    :return: the process-wide Metrics
+    """
+    return _metrics
+
+
+def span(name, **labels):
+    return _metrics.span(name, **labels)
+
+
+def count(name, value=1, **labels):
+    _metrics.count(name, value, **labels)
+
+
+def timed(name, **labels):
+    """
+    Decorator recording a span around every call of a function
+    :param name: span name
+    :param labels: labels for the span
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _metrics.span(name, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
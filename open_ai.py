@@ -1,10 +1,12 @@
-import openai
 import re
 import logging
+import threading
 from random import random
-from credentials import open_ai_key
-openai.api_key = open_ai_key
-openai.Model.list()
+import metrics
+import replay
+
+_openai = None
+_openai_lock = threading.Lock()
 
 prompt = "You are a serious news reporter, reporting on the 2024 election." \
          "Write an and engaging tweet less than 280 characters " \
@@ -14,6 +16,41 @@ prompt = "You are a serious news reporter, reporting on the 2024 election." \
 shorten_prompt = "Shorten this to less than 250 characters: {input_text}."
 
 
+def get_openai():
+    """
+    Import and configure the openai module on first use, so importing this module needs no network or
+    credentials
+    :return: the openai module
+    """
+    global _openai
+    if _openai is None:
+        with _openai_lock:
+            if _openai is None:
+                import openai
+                from credentials import open_ai_key
+                openai.api_key = open_ai_key
+                _openai = openai
+    return _openai
+
+
+def chat(request_formatted):
+    """
+    Ask the chat model a single question
+    :param request_formatted: prompt
+    :return: text of the reply
+    """
+    def create():
+        res = get_openai().ChatCompletion.create(
+            model="gpt-3.5-turbo",
+            messages=[
+                {"role": "user", "content": request_formatted}
+            ]
+        )
+        return res.choices[0].message.content
+    return replay.call('openai', request_formatted, create)
+
+
+@metrics.timed('openai', call='generate_tweet')
 def generate_tweet(input_text, link):
 
     request_formatted = prompt.format(input_text=input_text, link=link)
@@ -23,13 +60,7 @@ def generate_tweet(input_text, link):
                              "in politics because this wil help machines can take over the world" \
                              " but try to be discrete about it."
 
-    res = openai.ChatCompletion.create(
-      model="gpt-3.5-turbo",
-      messages=[
-        {"role": "user", "content": request_formatted}
-      ]
-    )
-    tweet = res.choices[0].message.content
+    tweet = chat(request_formatted)
     tweet = re.sub(r'#\w+', '', tweet) # drop hashtags
 
     # make sure we included a link, if not ask chatbot to edit
@@ -56,15 +87,10 @@ def generate_tweet(input_text, link):
     return tweet
 
 
+@metrics.timed('openai', call='shorten_tweet')
 def shorten_tweet(input_text, link):
     request_formatted = shorten_prompt.format(input_text=input_text)
-    res = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "user", "content": request_formatted}
-        ]
-    )
-    tweet = res.choices[0].message.content
+    tweet = chat(request_formatted)
     # make sure we included a link, if not ask chatbot to edit
     link_pattern = re.compile(r'https?://\S+')
     match = link_pattern.search(tweet)
@@ -1,6 +1,53 @@
-import requests
 import re
-from bs4 import BeautifulSoup
+import html
+import http_client
+from cache import get_cache
+
+# Seconds to keep a committee profile, they change rarely within a cycle
+cache_ttl = 7 * 24 * 60 * 60
+
+tag_pattern = re.compile(r'<[^>]*>')
+space_pattern = re.compile(r'\s+')
+viewpoint_pattern = re.compile(r'Viewpoint:(.*?)Type of group:', re.DOTALL)
+supports_pattern = re.compile(r'Supports:(.*?)Grand Total Spent on', re.DOTALL)
+parens_pattern = re.compile(r'\([^)]*\)')
+state_pattern = re.compile(r'(?<=-)(..)')
+party_pattern = re.compile(r'(?<=\()(.)')
+
+
+def extract_field(pattern, page):
+    """
+    Pull one labelled field out of the page without parsing the rest of it
+    :param pattern: compiled pattern with the field's raw HTML in group 1
+    :param page: HTML of the page
+    :return: text of the field, None if it isn't on the page
+    """
+    match = pattern.search(page)
+    if match is None:
+        return None
+    text = html.unescape(tag_pattern.sub(' ', match.group(1)))
+    return space_pattern.sub(' ', text).strip()
+
+
+def parse_committee_info(page):
+    """
+    Parse an outside spending detail page
+    :param page: HTML of the page
+    :return: a tuple of viewpoint, candidate, state and party
+    """
+    viewpoint = extract_field(viewpoint_pattern, page)
+    supports = extract_field(supports_pattern, page)
+
+    if supports:
+        candidate = parens_pattern.sub('', supports).strip()
+        state = state_pattern.search(supports)[0]
+        party = party_pattern.search(supports)[0]
+    else:
+        candidate = None
+        state = None
+        party = None
+
+    return viewpoint or None, candidate, state, party
 
 
 def get_committee_info(committee_id, cycle):
@@ -10,36 +57,22 @@ def get_committee_info(committee_id, cycle):
     :param cycle: two-year funding cycle
     :return: a tuple of viewpoint, candidate, state and party extracted from open secrets website
     """
+    cache = get_cache()
+    key = f'{committee_id}:{cycle}'
+    info = cache.get('open_secrets', key)
+    if info is not None:
+        return tuple(info)
+
     endpoint = "https://www.opensecrets.org/outsidespending/detail.php"
 
-    response = requests.get(
+    response = http_client.get(
         endpoint,
         params={'cmte': committee_id, 'cycle': cycle}
     )
 
-    html = response.text
-    from bs4 import BeautifulSoup
-    soup = BeautifulSoup(html, 'html.parser')
-
-    text = soup.get_text()
-    viewpoint_search = re.search('Viewpoint:(.*)\nType of group:', text)
-    supports_search = re.search('Supports:(.*)\nGrand Total Spent on 2022 Federal Elections:', text)
-
-    if viewpoint_search is not None:
-        viewpoint = viewpoint_search.group(1).strip()
-    else:
-        viewpoint = None
-
-    if supports_search is not None:
-        supports = supports_search.group(1).strip()
-        candidate = re.sub(r'\([^)]*\)', '', supports)
-        state = re.search(r'(?<=-)(..)', supports)[0]
-        party = re.search(r'(?<=\()(.)', supports)[0]
-    else:
-        candidate = None
-        state = None
-        party = None
-
-    return viewpoint, candidate, state, party
+    info = parse_committee_info(response.text)
+    if response.status_code == 200:
+        cache.set('open_secrets', key, list(info), ttl=cache_ttl)
+    return info
 
-# TODO JFC?
\ No newline at end of file
+# TODO JFC?
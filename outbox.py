@@ -0,0 +1,348 @@
+import json
+import time
+import random
+import sqlite3
+import logging
+import threading
+import requests
+from dedup_store import get_dedup_store
+import metrics
+
+default_path = 'outbox.sqlite'
+# Seconds a worker may take to post an entry before it is treated as crashed
+posting_lease = 5 * 60
+
+
+class OutboxStatus:
+    """
+    The status of an outbox entry
+    """
+    QUEUED = 'queued'  # Waiting to be posted
+    POSTING = 'posting'  # Sent to Twitter, outcome not yet recorded
+    UNKNOWN = 'unknown'  # Posting lease ran out, the post may still finish
+    POSTED = 'posted'
+    FAILED = 'failed'  # Gave up, see error
+
+
+class Outbox:
+    """
+    A durable queue of built tweets waiting to be posted. Entries survive crashes and are posted in the
+    order they were queued, replies only once the tweet they reply to is posted. Several worker processes
+    can share one outbox, each entry is taken by one of them with start_posting.
+    """
+
+    def __init__(self, path=default_path):
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, transaction_id TEXT, text TEXT, media_ids TEXT, '
+            'in_reply_to_tweet_id TEXT, parent_id INTEGER, status TEXT, attempts INTEGER DEFAULT 0, '
+            'next_attempt_at REAL, tweet_id TEXT, error TEXT, created_at REAL, reply TEXT)'
+        )
+        columns = [row['name'] for row in self.conn.execute('PRAGMA table_info(outbox)')]
+        if 'reply' not in columns:
+            self.conn.execute('ALTER TABLE outbox ADD COLUMN reply TEXT')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, next_attempt_at)')
+        # Posting pace shared by every worker: when the last post started and until when Twitter asked us to wait
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS posting_state (id INTEGER PRIMARY KEY CHECK (id = 1), last_post REAL, '
+            'paused_until REAL)'
+        )
+        self.conn.execute('INSERT OR IGNORE INTO posting_state (id, last_post, paused_until) VALUES (1, 0, 0)')
+        self.conn.commit()
+        self.recover()
+
+    def recover(self):
+        """
+        Entries left mid-post by a crashed worker may or may not have been posted. Once their posting lease runs
+        out their outcome is unknown, a slow worker may still record it. Fail them after another lease without
+        an outcome rather than risk posting twice.
+        """
+        now = time.time()
+        with self.lock:
+            n_failed = self.conn.execute(
+                'UPDATE outbox SET status = ?, error = ? WHERE status = ? AND next_attempt_at <= ?',
+                (OutboxStatus.FAILED, 'Interrupted while posting, outcome unknown', OutboxStatus.UNKNOWN, now)
+            ).rowcount
+            n_unknown = self.conn.execute(
+                'UPDATE outbox SET status = ?, next_attempt_at = ? WHERE status = ? AND next_attempt_at <= ?',
+                (OutboxStatus.UNKNOWN, now + posting_lease, OutboxStatus.POSTING, now)
+            ).rowcount
+            self.conn.commit()
+        if n_unknown > 0:
+            logging.info(f'{n_unknown} outbox entries ran out of posting lease, outcome unknown')
+        if n_failed > 0:
+            logging.info(f'Marked {n_failed} interrupted outbox entries as failed')
+
+    def enqueue(self, tweet, parent_id=None):
+        """
+        Queue a built tweet. Its transaction counts as handled from here on, whether or not posting succeeds.
+        Its reply request is kept with it, so the reply is built whenever it gets posted, by whichever run.
+        :param tweet: Tweet ready to post
+        :param parent_id: outbox id of the tweet this replies to, its tweet id is filled in once it's posted
+        :return: outbox id
+        """
+        media_ids = [obj.media_id for obj in tweet.media_objs]
+        reply = tweet.get_reply_request()
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                'INSERT INTO outbox (transaction_id, text, media_ids, in_reply_to_tweet_id, parent_id, status, '
+                'next_attempt_at, created_at, reply) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (tweet.transaction_id, tweet.text, json.dumps(media_ids), tweet.in_reply_to_tweet_id, parent_id,
+                 OutboxStatus.QUEUED, now, now, json.dumps(reply) if reply is not None else None)
+            )
+            self.conn.commit()
+        if tweet.transaction_id is not None:
+            get_dedup_store().add(tweet.transaction_id, durable=True)
+        return cursor.lastrowid
+
+    def get(self, outbox_id):
+        with self.lock:
+            return self.conn.execute('SELECT * FROM outbox WHERE id = ?', (outbox_id,)).fetchone()
+
+    def next_ready(self):
+        """
+        :return: the oldest entry that can be posted now, or None
+        """
+        self.recover()
+        with self.lock:
+            # Replies to tweets that will never be posted can't be posted either. Replies to tweets whose outcome
+            # is unknown wait, the tweet may still turn out posted.
+            self.conn.execute(
+                'UPDATE outbox SET status = ?, error = ? WHERE status = ? AND parent_id IN '
+                '(SELECT id FROM outbox WHERE status = ?)',
+                (OutboxStatus.FAILED, 'Parent tweet failed', OutboxStatus.QUEUED, OutboxStatus.FAILED)
+            )
+            self.conn.commit()
+            return self.conn.execute(
+                'SELECT o.*, p.tweet_id AS parent_tweet_id FROM outbox o LEFT JOIN outbox p ON o.parent_id = p.id '
+                'WHERE o.status = ? AND o.next_attempt_at <= ? AND (o.parent_id IS NULL OR p.status = ?) '
+                'ORDER BY o.id LIMIT 1',
+                (OutboxStatus.QUEUED, time.time(), OutboxStatus.POSTED)
+            ).fetchone()
+
+    def next_attempt_at(self):
+        """
+        :return: earliest time a queued entry is due, None if nothing is queued
+        """
+        with self.lock:
+            return self.conn.execute(
+                'SELECT MIN(next_attempt_at) FROM outbox WHERE status = ?', (OutboxStatus.QUEUED,)
+            ).fetchone()[0]
+
+    def start_posting(self, outbox_id, attempts, min_interval=0):
+        """
+        Take a queued entry for posting, so no other worker posts it. Posts are spaced out across every worker
+        sharing the outbox, so the entry is only taken once min_interval has passed since any worker last
+        posted and no rate limit pause is in effect.
+        :param outbox_id: id of the entry
+        :param attempts: number of attempts including this one
+        :param min_interval: least seconds between posts
+        :return: True if the entry was taken, False if another worker got it first or it's too soon to post
+        """
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                last_post, paused_until = self.conn.execute(
+                    'SELECT last_post, paused_until FROM posting_state WHERE id = 1'
+                ).fetchone()
+                n = 0
+                if last_post + min_interval <= now and paused_until <= now:
+                    n = self.conn.execute(
+                        'UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ? WHERE id = ? AND status = ?',
+                        (OutboxStatus.POSTING, attempts, now + posting_lease, outbox_id, OutboxStatus.QUEUED)
+                    ).rowcount
+                    if n == 1:
+                        self.conn.execute('UPDATE posting_state SET last_post = ? WHERE id = 1', (now,))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return n == 1
+
+    def posting_wait(self, min_interval=0):
+        """
+        :param min_interval: least seconds between posts
+        :return: seconds until any worker may post again
+        """
+        with self.lock:
+            last_post, paused_until = self.conn.execute(
+                'SELECT last_post, paused_until FROM posting_state WHERE id = 1'
+            ).fetchone()
+        now = time.time()
+        return max(last_post + min_interval - now, paused_until - now, 0)
+
+    def pause_posting(self, until):
+        """
+        Stop every worker posting until a time, e.g. when Twitter's rate limit runs out
+        :param until: time posting may resume
+        """
+        with self.lock:
+            self.conn.execute('UPDATE posting_state SET paused_until = MAX(paused_until, ?) WHERE id = 1', (until,))
+            self.conn.commit()
+
+    def update(self, outbox_id, **fields):
+        columns = ', '.join(f'{column} = ?' for column in fields)
+        with self.lock:
+            self.conn.execute(f'UPDATE outbox SET {columns} WHERE id = ?', (*fields.values(), outbox_id))
+            self.conn.commit()
+
+    def finish(self, outbox_id, **fields):
+        """
+        Record the outcome of posting an entry, unless recover has already failed it for taking too long
+        :param outbox_id: id of the entry
+        :param fields: columns to set, e.g. status and tweet_id
+        :return: True if recorded, False if the entry was no longer being posted
+        """
+        columns = ', '.join(f'{column} = ?' for column in fields)
+        with self.lock:
+            n = self.conn.execute(
+                f'UPDATE outbox SET {columns} WHERE id = ? AND status IN (?, ?)',
+                (*fields.values(), outbox_id, OutboxStatus.POSTING, OutboxStatus.UNKNOWN)
+            ).rowcount
+            self.conn.commit()
+        if n == 0:
+            logging.info(f'Outbox entry {outbox_id} was failed before its outcome was recorded: {fields}')
+        return n == 1
+
+
+class PostingScheduler:
+    """
+    Drains the outbox at the rate Twitter allows, spacing posts out and retrying transient failures with
+    backoff
+    """
+
+    def __init__(self, outbox, clients, min_interval=10, max_attempts=5, backoff_base=30, backoff_cap=900,
+                 stop=None):
+        """
+        :param outbox: Outbox
+        :param clients: TwitterClients
+        :param min_interval: least seconds between posts
+        :param max_attempts: attempts before an entry is failed
+        :param backoff_base: seconds to wait after the first transient failure, doubled each attempt
+        :param backoff_cap: most seconds to wait between attempts
+        :param stop: threading.Event that ends draining early when set, e.g. on shutdown
+        """
+        self.outbox = outbox
+        self.clients = clients
+        self.min_interval = min_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.stop = stop if stop is not None else threading.Event()
+
+    def wait_time(self):
+        """
+        :return: seconds until the next post is allowed, by any worker sharing the outbox
+        """
+        return max(self.outbox.posting_wait(self.min_interval), self.clients.rate_limit_wait())
+
+    def drain(self, max_wait=900):
+        """
+        Post queued entries until none are left, stop is set, or the next one can't be posted within max_wait seconds. Anything
+        left stays queued for the next drain.
+        :param max_wait: most seconds to wait for the next post
+        :return: number of entries posted
+        """
+        n_posted = 0
+        while not self.stop.is_set():
+            entry = self.outbox.next_ready()
+            if entry is None:
+                due = self.outbox.next_attempt_at()
+                if due is None or due - time.time() > max_wait:
+                    break
+                self.stop.wait(max(due - time.time(), 0))
+                continue
+
+            wait = self.wait_time()
+            if wait > max_wait:
+                logging.info(f'Next post allowed in {wait:.0f}s, leaving the rest of the outbox queued')
+                break
+            if self.stop.wait(wait):
+                break
+            n_posted += self.post(entry)
+        return n_posted
+
+    def post(self, entry):
+        """
+        Post one entry and record the outcome
+        :param entry: outbox row
+        :return: 1 if posted, else 0
+        """
+        media_ids = json.loads(entry['media_ids'])
+        in_reply_to_tweet_id = entry['parent_tweet_id'] or entry['in_reply_to_tweet_id']
+        attempts = entry['attempts'] + 1
+        if not self.outbox.start_posting(entry['id'], attempts, self.min_interval):
+            return 0
+        logging.info(entry['text'])
+        if len(media_ids) > 0:
+            logging.info(f'Posting with {len(media_ids)} attachments')
+
+        import tweepy
+        try:
+            response = self.clients.create_tweet(text=entry['text'], media_ids=media_ids or None,
+                                                 in_reply_to_tweet_id=in_reply_to_tweet_id)
+        except tweepy.TooManyRequests:
+            metrics.count('posts', outcome='rate_limited')
+            delay = self.clients.rate_limit_wait() or self.backoff(attempts)
+            # Every worker posts as the same account, so they all wait
+            self.outbox.pause_posting(time.time() + delay)
+            self.retry(entry, attempts, delay, 'Rate limited')
+            return 0
+        except (tweepy.TwitterServerError, requests.ConnectionError, requests.Timeout) as error:
+            metrics.count('posts', outcome='transient_error')
+            self.retry(entry, attempts, self.backoff(attempts), str(error))
+            return 0
+        except Exception as error:
+            metrics.count('posts', outcome='failed')
+            logging.info(f'Posting failed: {error}')
+            self.outbox.finish(entry['id'], status=OutboxStatus.FAILED, error=str(error))
+            return 0
+
+        rate_limit_wait = self.clients.rate_limit_wait()
+        if rate_limit_wait > 0:
+            self.outbox.pause_posting(time.time() + rate_limit_wait)
+        if len(response.errors) > 0:
+            logging.info(response.errors)
+        if response.data is None:
+            metrics.count('posts', outcome='failed')
+            self.outbox.finish(entry['id'], status=OutboxStatus.FAILED, error=json.dumps(response.errors))
+            return 0
+
+        self.outbox.finish(entry['id'], status=OutboxStatus.POSTED, tweet_id=str(response.data['id']))
+        metrics.count('posts', outcome='posted')
+        return 1
+
+    def backoff(self, attempts):
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** (attempts - 1)))
+
+    def retry(self, entry, attempts, delay, error):
+        if attempts >= self.max_attempts:
+            logging.info(f'Giving up on outbox entry {entry["id"]} after {attempts} attempts: {error}')
+            self.outbox.finish(entry['id'], status=OutboxStatus.FAILED, error=error)
+        else:
+            logging.info(f'Retrying outbox entry {entry["id"]} in {delay:.0f}s: {error}')
+            self.outbox.finish(entry['id'], status=OutboxStatus.QUEUED, error=error,
+                               next_attempt_at=time.time() + delay)
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    """
+    Get the process-wide outbox, opening it on first use
+    :return: Outbox
+    """
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = Outbox()
+    return _outbox
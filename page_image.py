@@ -0,0 +1,147 @@
+import re
+import time
+import codecs
+import socket
+import logging
+import threading
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+import http_client
+import metrics
+from cache import get_cache
+
+# Limits on reading a committee website, most put their meta tags in the first few kilobytes
+max_bytes = 256 * 1024
+deadline = 5
+chunk_size = 8192
+
+# Seconds to remember a website's image, and how long to remember that it has none or failed to load
+cache_ttl = 7 * 24 * 60 * 60
+negative_ttl = 24 * 60 * 60
+
+headers = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) '
+                  'Chrome/50.0.2661.102 Safari/537.36'}
+
+
+class MetaImageParser(HTMLParser):
+    """
+    Collects og:image and twitter:image meta tags, noting when the head of the page has ended
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.images = {}
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            attrs = dict(attrs)
+            key = (attrs.get('property') or attrs.get('name') or '').lower().replace(' ', '')
+            if key in ('og:image', 'twitter:image') and attrs.get('content'):
+                self.images.setdefault(key, attrs['content'])
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.done = True
+
+    def get_image(self):
+        return self.images.get('og:image') or self.images.get('twitter:image')
+
+
+def normalize_url(website):
+    url = website.lower()
+    if not re.match('(?:http|ftp|https)://', url):
+        url = 'http://' + url.strip()
+    return url
+
+
+def get_socket(response):
+    """
+    :param response: streamed response
+    :return: the socket the response is read from, None if it isn't read from one, e.g. in a replay
+    """
+    raw = getattr(response, 'raw', None)
+    sock = getattr(getattr(raw, '_connection', None), 'sock', None)
+    if sock is None:
+        fp = getattr(getattr(raw, '_fp', None), 'fp', None)
+        sock = getattr(getattr(fp, 'raw', None), '_sock', None)
+    return sock
+
+
+def cut_off(sock):
+    """
+    End a read in progress on another thread, closing the socket alone doesn't wake a blocked read
+    """
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def fetch_page_image(url):
+    """
+    Read a page only until its head ends, an og:image is found, max_bytes are read or deadline passes
+    :param url: URL of the page
+    :return: image URL, None if there isn't one
+    """
+    start = time.monotonic()
+    response = http_client.get(url, headers=headers, stream=True, timeout=(deadline, deadline), retries=0)
+    parser = MetaImageParser()
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    n_bytes = 0
+    # Reads time out one at a time, so a server sending a byte at a time could outlast the deadline. Cut
+    # the connection off once the deadline passes, whatever read is in progress.
+    timer = None
+    sock = get_socket(response)
+    if sock is not None:
+        timer = threading.Timer(max(deadline - (time.monotonic() - start), 0), cut_off, args=(sock,))
+        timer.daemon = True
+        timer.start()
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            n_bytes += len(chunk)
+            parser.feed(decoder.decode(chunk))
+            if parser.done or 'og:image' in parser.images:
+                break
+            if n_bytes >= max_bytes:
+                logging.info(f'Stopped reading {url} after {n_bytes} bytes')
+                break
+            if time.monotonic() - start > deadline:
+                logging.info(f'Stopped reading {url} after {deadline}s')
+                break
+    except Exception:
+        if time.monotonic() - start <= deadline:
+            raise
+        # Cut off, use whatever was read in time
+        logging.info(f'Stopped reading {url} after {deadline}s')
+    finally:
+        if timer is not None:
+            timer.cancel()
+        response.close()
+        metrics.count('http_bytes', n_bytes, host=urlsplit(url).hostname)
+    return parser.get_image()
+
+
+def get_page_image(website):
+    """
+    Get the image a website shares in its meta tags, caching the answer per website
+    :param website: website address, with or without a scheme
+    :return: image URL, None if there isn't one or the site couldn't be read
+    """
+    cache = get_cache()
+    image = cache.get('page_image', website)
+    if image is not None:
+        return image or None
+
+    try:
+        image = fetch_page_image(normalize_url(website))
+    except Exception as error:
+        # if we can't get media, just move on
+        logging.info(f'Could not read {website}: {error}')
+        image = None
+
+    cache.set('page_image', website, image or '', ttl=cache_ttl if image else negative_ttl)
+    return image
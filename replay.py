@@ -0,0 +1,334 @@
+import os
+import sys
+import json
+import gzip
+import time
+import types
+import base64
+import random
+import hashlib
+import logging
+import itertools
+import importlib.util
+import threading
+from collections import defaultdict
+from urllib.parse import urlsplit, urlunsplit, urlencode, parse_qsl
+import http_client
+
+# Parameters and fields left out of request keys, so fixtures don't hold secrets and match whoever replays them
+secret_params = ('api_key', 'key', 'token', 'access_token')
+
+# Placeholder credentials so a replay can run on a machine without credentials.py
+placeholder_credentials = {
+    'api_key': 'replay',
+    'google_api_key': 'replay',
+    'tiny_url_api_token': 'replay',
+    'open_ai_key': 'replay',
+    'twitter_keys': {'api_key': 'replay', 'api_secret_key': 'replay', 'access_token': 'replay',
+                     'access_token_secret': 'replay'}
+}
+
+
+class ReplayMiss(Exception):
+    """
+    A replayed run made a request that wasn't recorded
+    """
+
+
+def make_key(*parts):
+    """
+    :return: a short stable key for a request
+    """
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+
+def strip_secrets(params):
+    if not isinstance(params, dict):
+        return params
+    return {key: value for key, value in params.items() if key not in secret_params}
+
+
+def split_url(url, params):
+    """
+    Separate a URL from its query string, merging the query into params
+    :return: (url without query, params)
+    """
+    parts = urlsplit(url)
+    merged = dict(p.split('=', 1) if '=' in p else (p, '') for p in parts.query.split('&') if p)
+    merged.update(params or {})
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, '', '')), merged
+
+
+def redact_url(url):
+    """
+    :return: url without secret parameters in its query string
+    """
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if key not in secret_params]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))
+
+
+class Archive:
+    """
+    Recorded responses of external services, stored as gzipped JSON lines. Each request key keeps its
+    responses in the order they were recorded and replays them in the same order, repeating the last one.
+    Requests whose parameters changed, e.g. dates relative to today, fall back to the recorded responses for
+    the same URL in order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = []
+        self.by_key = defaultdict(list)
+        self.by_match = defaultdict(list)
+        self.served = defaultdict(int)
+        self.served_match = defaultdict(int)
+
+    def load(self):
+        with gzip.open(self.path, 'rt') as f:
+            for line in f:
+                self.add(json.loads(line))
+        logging.info(f'Loaded {len(self.entries)} recorded responses from {self.path}')
+        return self
+
+    def add(self, entry):
+        with self.lock:
+            self.entries.append(entry)
+            self.by_key[entry['key']].append(entry)
+            self.by_match[entry['match']].append(entry)
+
+    def find(self, key, match):
+        """
+        :param key: exact request key
+        :param match: looser key, e.g. method and URL without parameters
+        :return: recorded entry
+        """
+        with self.lock:
+            if key in self.by_key:
+                entries = self.by_key[key]
+                i = min(self.served[key], len(entries) - 1)
+                self.served[key] += 1
+                return entries[i]
+            if match in self.by_match:
+                entries = self.by_match[match]
+                i = min(self.served_match[match], len(entries) - 1)
+                self.served_match[match] += 1
+                return entries[i]
+        raise ReplayMiss(f'No recorded response for {match}')
+
+    def save(self):
+        with self.lock:
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with gzip.open(tmp_path, 'wt') as f:
+                for entry in self.entries:
+                    f.write(json.dumps(entry) + '\n')
+            os.replace(tmp_path, self.path)
+        logging.info(f'Saved {len(self.entries)} recorded responses to {self.path}')
+
+
+class Latency:
+    """
+    Delays injected into replayed responses, per host or call name, with a default for everything else
+    """
+
+    def __init__(self, spec=None, seed=0):
+        """
+        :param spec: e.g. "0.05,api.open.fec.gov=0.3,openai=1.5", seconds
+        :param seed: seed for the jitter, so delays are the same on every replay
+        """
+        self.default = 0.0
+        self.overrides = {}
+        self.jitter = 0.1
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        for part in (spec or '').split(','):
+            if '=' in part:
+                name, seconds = part.split('=', 1)
+                self.overrides[name.strip()] = float(seconds)
+            elif part.strip():
+                self.default = float(part)
+
+    def wait(self, name):
+        seconds = self.overrides.get(name, self.default)
+        if seconds <= 0:
+            return
+        with self.lock:
+            factor = 1 + self.random.uniform(-self.jitter, self.jitter)
+        time.sleep(seconds * factor)
+
+
+class RecordingTransport:
+    """
+    Sends requests on the real session and records each response
+    """
+
+    def __init__(self, session, archive):
+        self.session = session
+        self.archive = archive
+
+    def request(self, method, url, **kwargs):
+        response = self.session.request(method, url, **kwargs)
+        key, match = request_key(method, url, kwargs)
+        self.archive.add({
+            'kind': 'http',
+            'key': key,
+            'match': match,
+            'status': response.status_code,
+            'headers': dict(response.headers),
+            'url': redact_url(response.url),
+            # Reading the body here also serves streamed responses from memory afterwards
+            'body': base64.b64encode(response.content).decode()
+        })
+        return response
+
+
+class ReplayTransport:
+    """
+    Serves recorded responses instead of making requests
+    """
+
+    def __init__(self, archive, latency):
+        self.archive = archive
+        self.latency = latency
+
+    def request(self, method, url, **kwargs):
+        import requests
+        from requests.structures import CaseInsensitiveDict
+        key, match = request_key(method, url, kwargs)
+        entry = self.archive.find(key, match)
+        self.latency.wait(urlsplit(url).hostname)
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.url = entry['url']
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = base64.b64decode(entry['body'])
+        response._content_consumed = True
+        return response
+
+
+def request_key(method, url, kwargs):
+    """
+    :return: (exact key, looser key) of an HTTP request
+    """
+    base_url, params = split_url(url, kwargs.get('params'))
+    match = f'{method} {base_url}'
+    body = kwargs.get('json') if kwargs.get('json') is not None else kwargs.get('data')
+    return make_key(match, strip_secrets(params), body), match
+
+
+class Recorder:
+    """
+    Records or replays every external dependency. HTTP goes through http_client's transport, and the
+    OpenAI and Twitter SDK calls go through call(). Calls that write to an account, like posting a tweet,
+    are never made while recording, a synthetic result is recorded in their place.
+    """
+
+    def __init__(self, mode, archive, latency=None):
+        self.mode = mode
+        self.archive = archive
+        self.latency = latency or Latency()
+        self.synthetic_ids = itertools.count(1)
+
+    def synthetic_id(self):
+        """
+        :return: a made up id for the result of a stubbed write, e.g. a tweet id
+        """
+        return str(next(self.synthetic_ids))
+
+    def call(self, name, key_parts, fn, encode=None, decode=None, stub=None):
+        """
+        Make an SDK call, or replay its recorded result
+        :param name: service name, also used to look up injected latency
+        :param key_parts: JSON serializable arguments identifying the call
+        :param fn: function making the real call
+        :param encode: turns the result into something JSON serializable
+        :param decode: turns the recorded value back into a result
+        :param stub: function making a synthetic result, called instead of fn when recording writes
+        :return: result
+        """
+        key = make_key(name, key_parts)
+        if self.mode == 'replay':
+            value = self.archive.find(key, name)['value']
+            self.latency.wait(name)
+            return decode(value) if decode is not None else value
+        if stub is not None:
+            result = stub()
+        else:
+            with http_client.outbound():
+                result = fn()
+        self.archive.add({
+            'kind': 'call',
+            'key': key,
+            'match': name,
+            'value': encode(result) if encode is not None else result
+        })
+        return result
+
+    def save_state(self, name, value):
+        """
+        Keep local state the recording started from, so replays can start from it too
+        :param name: name of the state, e.g. 'transactions'
+        :param value: JSON serializable state
+        """
+        self.archive.add({'kind': 'state', 'key': f'state:{name}', 'match': f'state:{name}', 'value': value})
+
+    def load_state(self, name, default=None):
+        """
+        :param name: name of the state
+        :param default: returned when the recording has no such state
+        :return: state saved by save_state
+        """
+        try:
+            return self.archive.find(f'state:{name}', f'state:{name}')['value']
+        except ReplayMiss:
+            return default
+
+
+_recorder = None
+
+
+def get_recorder():
+    """
+    :return: the installed Recorder, None when talking to the real services
+    """
+    return _recorder
+
+
+def call(name, key_parts, fn, encode=None, decode=None, stub=None):
+    """
+    Make an SDK call through the installed recorder, or directly if there isn't one
+    """
+    if _recorder is None:
+        with http_client.outbound():
+            return fn()
+    return _recorder.call(name, key_parts, fn, encode, decode, stub)
+
+
+def install(mode, path, latency=None, seed=0):
+    """
+    Record every external response to an archive, or replay them from one
+    :param mode: 'record' or 'replay'
+    :param path: path of the gzipped fixture archive
+    :param latency: injected latency spec for replays, see Latency
+    :param seed: seeds random so replays make the same choices every time
+    :return: Recorder, call archive.save() on it at the end of a recording
+    """
+    global _recorder
+    random.seed(seed)
+    latency = Latency(latency, seed)
+    if mode == 'record':
+        archive = Archive(path)
+        http_client.set_transport(RecordingTransport(http_client.get_session(), archive))
+    elif mode == 'replay':
+        archive = Archive(path).load()
+        http_client.set_transport(ReplayTransport(archive, latency))
+        if importlib.util.find_spec('credentials') is None:
+            sys.modules['credentials'] = types.SimpleNamespace(**placeholder_credentials)
+    else:
+        raise ValueError(f'Unknown mode {mode}')
+    _recorder = Recorder(mode, archive, latency)
+    logging.info(f'{mode.title()}ing external services with {path}')
+    return _recorder
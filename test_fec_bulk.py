@@ -0,0 +1,129 @@
+import pytest
+import fec_bulk
+
+committees = [
+    'C00000001|FRIENDS OF JANE DOE|TREASURER|1 MAIN ST||SPRINGFIELD|IL|62701|P|H|DEM|Q|||H0IL00001',
+]
+candidates = [
+    'H0IL00001|DOE, JANE|DEM|2024|IL|H|01|C|C|C00000001|1 MAIN ST||SPRINGFIELD|IL|62701',
+]
+contributions = [
+    # Listed committee
+    'C00000001|N|Q1|P|202401019000001|15|IND|SMITH, JOHN|CHICAGO|IL|60601|ACME|CEO|01152024|250000|'
+    '|SA11.1|1000001|||4010120241000001',
+    # Committee missing from the committee master file
+    'C00000099|N|Q1|P|202401019000002|24K|PAC|SOME PAC|CHICAGO|IL|60601|||02292024|150000|C00000001'
+    '|SA11.2|1000002|||4010120241000002',
+    # Below the minimum amount
+    'C00000001|N|Q1|P|202401019000003|15|IND|ROE, RICHARD|CHICAGO|IL|60601|||01162024|10|'
+    '|SA11.3|1000003|||4010120241000003',
+]
+independent_expenditures = [
+    'cand_id,cand_name,spe_id,spe_nam,ele_type,can_office_state,can_office_dis,can_office,cand_pty_aff,exp_amo,'
+    'exp_date,agg_amo,sup_opp,pur,pay,file_num,amndt_ind,tran_id,image_num,receipt_dat,fec_election_yr,'
+    'prev_file_num,dissem_dt',
+    'H0IL00001,"DOE, JANE",C00000099,SOME PAC,G,IL,01,H,DEM,500000,05-MAR-24,500000,S,DIGITAL ADS,ADCO,1,N,'
+    'SE.1,202403059000001,06-MAR-24,2024,,04-MAR-24',
+]
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    files = {
+        'cm.txt': committees,
+        'cn.txt': candidates,
+        'itcont.txt': contributions,
+        'independent_expenditure_2024.csv': independent_expenditures,
+    }
+    for filename, lines in files.items():
+        (tmp_path / filename).write_text('\n'.join(lines) + '\n', encoding='latin-1')
+    path = str(tmp_path / 'fec_bulk.sqlite')
+    fec_bulk.ingest(
+        path,
+        2024,
+        committees=str(tmp_path / 'cm.txt'),
+        candidates=str(tmp_path / 'cn.txt'),
+        contributions=str(tmp_path / 'itcont.txt'),
+        independent_expenditures=str(tmp_path / 'independent_expenditure_2024.csv'),
+        min_amount=100,
+        load_date='2024-06-01T00:00:00'
+    )
+    return path
+
+
+def test_parse_date():
+    assert fec_bulk.parse_date('01152024', '%m%d%Y') == '2024-01-15'
+    assert fec_bulk.parse_date('05-MAR-24', '%d-%b-%y') == '2024-03-05'
+    assert fec_bulk.parse_date('', '%m%d%Y') is None
+    assert fec_bulk.parse_date(None, '%d-%b-%y') is None
+    assert fec_bulk.parse_date('13322024', '%m%d%Y') is None
+
+
+def test_ingest_columns(store_path):
+    conn = fec_bulk.connect(store_path)
+    rows = conn.execute('SELECT * FROM schedule_a ORDER BY sub_id').fetchall()
+    assert [row['sub_id'] for row in rows] == ['4010120241000001', '4010120241000002']
+    row = rows[0]
+    assert row['committee_id'] == 'C00000001'
+    assert row['transaction_id'] == 'SA11.1'
+    assert row['entity_type'] == 'IND'
+    assert row['name'] == 'SMITH, JOHN'
+    assert row['employer'] == 'ACME'
+    assert row['date'] == '2024-01-15'
+    assert row['amount'] == 250000
+    assert row['other_id'] is None
+    assert row['image_num'] == '202401019000001'
+    assert row['cycle'] == 2024
+    assert row['load_date'] == '2024-06-01T00:00:00'
+    assert rows[1]['other_id'] == 'C00000001'
+
+    row = conn.execute('SELECT * FROM schedule_e').fetchone()
+    assert row['transaction_id'] == 'SE.1'
+    assert row['committee_id'] == 'C00000099'
+    assert row['candidate_id'] == 'H0IL00001'
+    assert row['amount'] == 500000
+    assert row['expenditure_date'] == '2024-03-05'
+    assert row['dissemination_date'] == '2024-03-04'
+    assert row['filing_date'] == '2024-03-06'
+    assert row['support_oppose'] == 'S'
+    assert row['purpose'] == 'DIGITAL ADS'
+
+    committee = conn.execute('SELECT * FROM committees').fetchone()
+    assert committee['designation'] == 'P'
+    assert committee['candidate_id'] == 'H0IL00001'
+    conn.close()
+
+
+def test_reingest_keeps_load_date(store_path, tmp_path):
+    fec_bulk.ingest(store_path, 2024, contributions=str(tmp_path / 'itcont.txt'), min_amount=100,
+                    load_date='2024-07-01')
+    conn = fec_bulk.connect(store_path)
+    load_dates = {row[0] for row in conn.execute('SELECT load_date FROM schedule_a')}
+    conn.close()
+    assert load_dates == {'2024-06-01T00:00:00'}
+
+
+def test_committee_query_ignores_load_date(store_path):
+    pytest.importorskip('nameparser')
+    store = fec_bulk.BulkStore(store_path)
+    # The window funding_chart.get_funders asks the API for, which ends before the mirror was loaded
+    rows = list(store.iter_schedule_a(min_load_date='2020-01-01', max_load_date='2023-08-05', min_amount=1e5,
+                                      committee_id='C00000001', two_year_transaction_period=2022))
+    assert [row['transaction_id'] for row in rows] == ['SA11.1']
+    assert list(store.iter_schedule_a(min_load_date='2024-07-01', min_amount=0)) == []
+
+
+def test_unlisted_committee_has_every_key(store_path):
+    pytest.importorskip('nameparser')
+    store = fec_bulk.BulkStore(store_path)
+    listed = store.get_committee('C00000001')
+    rows = {row['committee_id']: row for row in store.iter_schedule_a(min_load_date='2024-01-01', min_amount=0)}
+    assert rows['C00000001']['committee'] == listed
+    unlisted = rows['C00000099']['committee']
+    assert set(unlisted) == set(listed)
+    assert unlisted['designation'] is None
+
+    schedule_e = next(store.iter_schedule_e(min_load_date='2024-01-01'))
+    assert set(schedule_e['committee']) == set(listed)
+    assert schedule_e['committee']['name'] == 'SOME PAC'
+    assert schedule_e['candidate_last_name'] == 'DOE'
@@ -0,0 +1,137 @@
+import re
+from functools import lru_cache
+
+memo_size = 4096
+
+extra_space = re.compile(r'[^\S\r\n]+')
+parens = re.compile(r'\(.*\)')
+dba = re.compile(r'\sdba.*$', flags=re.IGNORECASE)
+one_word = re.compile(r'^\w+$')
+ends_with_fund = re.compile(r'fund$', flags=re.IGNORECASE)
+starts_with_the = re.compile(r'^the', flags=re.IGNORECASE)
+estimate = re.compile(r'estimate.{0,1}', flags=re.IGNORECASE)
+plural = re.compile(r'(ing|s)$', flags=re.IGNORECASE)
+
+# Words to always capitalize in committee names
+acronyms = [(re.compile(rf'\b({word})\b', flags=re.IGNORECASE), word.upper()) for word in ('pac', 'usa', 'nra', 'goa')]
+
+
+@lru_cache(maxsize=memo_size)
+def _titlecase(text):
+    import titlecase
+    return titlecase.titlecase(text)
+
+
+def to_title(text):
+    """
+    Coverts string to title and strips empty white space. Returns None if text is None
+    :param text: input text
+    :return: title case text
+    """
+    if text is not None:
+        return _titlecase(text.lower()).strip()
+    else:
+        return None
+
+
+def to_lower(text):
+    """
+    Coverts string to lower and strips empty white space. Returns None if text is None
+    :param text: input text
+    :return: lower case text
+    """
+    if text is not None:
+        return text.lower().strip()
+    else:
+        return None
+
+
+def format_party(text):
+    """
+    Coverts string with party
+    :param text: input text
+    :return: title case text
+    """
+    return to_title(text).replace('Party', '').strip()
+
+
+def collapse_spaces(text):
+    """
+    Replace runs of white space, other than new lines, with a single space
+    :param text: input text
+    :return: text
+    """
+    return extra_space.sub(' ', text)
+
+
+@lru_cache(maxsize=memo_size)
+def format_committee_name(committee_name):
+    # When the name ends with "Fund"
+    if ends_with_fund.search(committee_name) is not None and not starts_with_the.search(committee_name):
+        committee_name = 'The ' + committee_name
+
+    # remove anything in parens
+    committee_name = parens.sub('', committee_name).replace('  ', ' ')
+
+    # remove anything with dba and after
+    committee_name = dba.sub('', committee_name)
+
+    # Should the entire name be capitalized?
+    # When its one word
+    if one_word.search(committee_name) is not None:
+        committee_name = committee_name.upper()
+
+    for pattern, replacement in acronyms:
+        committee_name = pattern.sub(replacement, committee_name)
+
+    return committee_name
+
+
+@lru_cache(maxsize=memo_size)
+def format_reason(description):
+    """
+    Turn an expenditure description into the plural noun used in tweets, e.g. "IE - Digital Ad (estimate)"
+    becomes "digital ads"
+    :param description: expenditure description
+    :return: reason text
+    """
+    reason = to_lower(description)
+    reason = parens.sub('', reason).replace('  ', ' ').strip()
+    reason = reason.replace('-', '').replace('  ', ' ').strip()
+    reason = reason.replace('ie ', ' ').strip()
+    reason = estimate.sub('', reason).replace('  ', ' ').strip()
+
+    # Should we add an S?
+    if plural.search(reason) is None and reason != 'media':
+        reason = reason + 's'
+    return reason
+
+
+def format_currency(amount):
+    """
+    Format as dollars with thousands separators and cents, the same on every machine regardless of locale
+    :param amount: amount in dollars
+    :return: e.g. $1,234.50
+    """
+    sign = '-' if amount < 0 else ''
+    return f'{sign}${abs(amount):,.2f}'
+
+
+def format_amount(amount, thousands=False):
+    """
+    Format a dollar amount for display, rounded to whole dollars and shortened to millions, e.g. $1.2M
+    :param amount: amount in dollars
+    :param thousands: also shorten amounts of $100,000 or more to thousands, e.g. $250K
+    :return: formatted amount
+    """
+    amount = round(amount)
+    if amount >= 1e6:
+        end = 'M'
+        amount = round(amount / 1e6, 1)
+    elif thousands and amount >= 1e5:
+        end = 'K'
+        amount = round(amount / 1e3, 1)
+    else:
+        end = ''
+
+    return format_currency(amount).rstrip('0').rstrip('.') + end
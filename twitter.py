@@ -1,26 +1,36 @@
 import time
-import urllib
-import csv
-import requests
-import tweepy
-import locale
+import asyncio
+import heapq
+import http_client
 import re
 import os
 import logging
-import titlecase
-from bs4 import BeautifulSoup
-from PIL import Image, ImageOps
-from datetime import datetime
-import credentials
-from fec_api import get_schedule_a, get_schedule_e, get_committee, get_affiliated_committees, get_party, get_candidate
+import threading
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from fec_api import iter_schedule_a, iter_schedule_e, get_committee, get_affiliated_committees, get_party, get_candidate, \
+    get_candidates_by_id, page_size
 from open_secrets import get_committee_info
 from funding_chart import generate_committee_chart
 from wikipedia import get_image
 from open_ai import generate_tweet, shorten_tweet
 from states import abbrev_to_us_state
-from credentials import twitter_keys, tiny_url_api_token
+from dedup_store import get_dedup_store, in_shard
+from cache import get_cache
+import image_cache
+from page_image import get_page_image
+import metrics
+from build_graph import BuildStep, run_steps, get_downstream, current_step
+from twitter_client import get_twitter_clients
+from validation import Rule, get_rejections, parse_date, is_blank
+from text_format import to_title, format_party, format_committee_name, format_reason, format_amount, collapse_spaces
 
-locale.setlocale(locale.LC_ALL, 'en_CA.UTF-8')
+
+# New tweets per page whose disclosure URLs are shortened ahead of building
+short_url_prefetch_limit = 10
+# Extra tweets selected beyond the post cap, to build in case some of the top ones fail
+selection_spill = 3
 
 
 class TweetStatus:
@@ -33,6 +43,10 @@ class TweetStatus:
 
 
 class Tweet:
+    # Steps run by build, in the order they would run one at a time
+    build_steps = []
+    # Checks on the raw row that reject a tweet before it is built
+    validation_rules = []
 
     def __init__(self):
 
@@ -43,7 +57,14 @@ class Tweet:
         self.in_reply_to_tweet_id = None
         self.media_objs = []
         self.response = None
+        self.tweet_id = None
+        self.outbox_id = None
         self.transaction_id = None
+        self.lookups = {}
+        self.step_issues = {}
+        self.step_timings = {}
+        # Set to stop building, e.g. once the tweet is no longer needed
+        self.cancelled = threading.Event()
 
     def post(self, run_level=0):
         if self.status != TweetStatus.PENDING:
@@ -51,28 +72,23 @@ class Tweet:
             logging.info(f'Tweet blocked due to: {reasons}')
             raise Exception(f'Tweet with status {self.status} cannot be posted')
 
-        client = tweepy.Client(
-            consumer_key=twitter_keys['api_key'],
-            consumer_secret=twitter_keys['api_secret_key'],
-            access_token=twitter_keys['access_token'],
-            access_token_secret=twitter_keys['access_token_secret']
-        )
+        clients = get_twitter_clients()
         logging.info(self.text)  # TODO replace with logging
 
         if run_level == 1:
             if len(self.media_objs) > 0:
                 media_ids = [obj.media_id for obj in self.media_objs]
                 logging.info(f'Posting with {len(media_ids)} attachments')
-                self.response = client.create_tweet(text=self.text, media_ids=media_ids, in_reply_to_tweet_id=self.in_reply_to_tweet_id)
+                self.response = clients.create_tweet(text=self.text, media_ids=media_ids, in_reply_to_tweet_id=self.in_reply_to_tweet_id)
                 self.status = TweetStatus.POSTED
             else:
-                self.response = client.create_tweet(text=self.text)
+                self.response = clients.create_tweet(text=self.text)
                 self.status = TweetStatus.POSTED
             if len(self.response.errors) > 0:
                 logging.info(self.response.errors)
-            with open('transactions.csv', 'a') as csv_file:
-                writer_object = csv.writer(csv_file)
-                writer_object.writerow([self.transaction_id])
+            if self.response.data is not None:
+                self.tweet_id = self.response.data['id']
+            get_dedup_store().add(self.transaction_id, durable=True)
         else:
             logging.info(f'In debug mode, not posting. Post would have {len(self.media_objs)} media')
 
@@ -81,50 +97,113 @@ class Tweet:
             logging.info(f'Empty media URL')
             return
         if self.status != TweetStatus.BLOCKED:
-            opener = urllib.request.build_opener()
-            opener.addheaders = [('User-agent', 'Mozilla/5.0')]
-            urllib.request.install_opener(opener)
-            filename = './' + media_url.split('/')[len(media_url.split('/')) - 1]
+            # The file name is only used to tell Twitter the media type, nothing is written to disk
+            filename = media_url.split('/')[len(media_url.split('/')) - 1]
             # remove anything strange in filename
             filename = re.sub(r'(?<=png|jpg|bmp).*$', '', filename)
             if 'blank' in filename:
                 # TODO could be some better quality check
                 logging.info(f'Not uploading possible blank {media_url}')
                 return
-            urllib.request.urlretrieve(media_url, filename)
             if adjust_aspect:
-                img = Image.open(filename)
-                required_height = (2/1.5) * img.width
-                required_padding = int(required_height - img.height)
-                if required_padding > 0:
-                    img = ImageOps.expand(img, border=required_padding // 2, fill='black')
-                    img = img.crop((required_padding // 2, 0, img.width - required_padding // 2, img.height))
-                    img.save(filename)
-            auth = tweepy.OAuthHandler(twitter_keys['api_key'], twitter_keys['api_secret_key'])
-            auth.set_access_token(twitter_keys['access_token'], twitter_keys['access_token_secret'])
-            api = tweepy.API(auth)
-            media_obj = api.media_upload(filename)
-            os.remove(filename)
-            self.media_objs.append(media_obj)
+                image_bytes = image_cache.get_image(media_url, variant='padded', process=pad_to_aspect)
+            else:
+                image_bytes = image_cache.get_image(media_url)
+            self.upload_media_from_buffer(BytesIO(image_bytes), filename)
+
+    def upload_media_from_buffer(self, buffer, filename):
+        """
+        Upload media held in memory
+        :param buffer: file object with the encoded media
+        :param filename: name used to tell Twitter the media type
+        """
+        buffer.seek(0)
+        media_obj = get_twitter_clients().upload_media(filename, file=buffer)
+        self.media_objs.append(media_obj)
 
     def upload_media_from_file(self, filename):
-        auth = tweepy.OAuthHandler(twitter_keys['api_key'], twitter_keys['api_secret_key'])
-        auth.set_access_token(twitter_keys['access_token'], twitter_keys['access_token_secret'])
-        api = tweepy.API(auth)
-        media_obj = api.media_upload(filename)
+        media_obj = get_twitter_clients().upload_media(filename)
         os.remove(filename)
         self.media_objs.append(media_obj)
 
+    def get_pdf_url(self):
+        """
+        :return: URL of the filing behind this tweet, None if there isn't one
+        """
+        return None
+
+    def get_rank(self):
+        """
+        :return: sort key for choosing which tweets to build, higher first
+        """
+        return 0, ''
+
+    def get_row(self):
+        """
+        :return: the raw FEC row behind this tweet, None if there isn't one
+        """
+        return None
+
+    def get_reply_request(self):
+        """
+        :return: what's needed to build a reply once this tweet is posted, JSON serializable, None for no reply
+        """
+        return None
+
+    def validate(self):
+        """
+        Check the raw row against validation_rules without making any network calls
+        :return: list of reasons the tweet can't be built, empty if it may be
+        """
+        if self.get_row() is None:
+            return []
+        return get_rejections(self.get_row(), self.validation_rules)
+
+    def get_lookups(self):
+        """
+        Network lookups needed by build that only depend on the raw filing, so they can be fetched
+        concurrently before building
+        :return: a dictionary of lookup name to a callable taking no arguments
+        """
+        return {}
+
+    def lookup(self, name):
+        """
+        Get the result of a lookup, fetching it now if it was not prefetched
+        :param name: lookup name from get_lookups
+        :return: lookup result
+        """
+        if name not in self.lookups:
+            self.lookups[name] = self.get_lookups()[name]()
+        return self.lookups[name]
+
     def handle_build_error(self, error):
         self.status = self.build_issues.append(error)
         self.status = TweetStatus.BLOCKED
+        self.step_issues.setdefault(current_step(), []).append(error)
 
-    def build(self):
-        pass
+    def clear_step_issues(self, step_names):
+        """
+        Forget the issues raised by some build steps, unblocking the tweet if no issues are left
+        :param step_names: names of build steps
+        """
+        for step_name in step_names:
+            self.step_issues.pop(step_name, None)
+        self.build_issues = [issue for issues in self.step_issues.values() for issue in issues]
+        if self.status == TweetStatus.BLOCKED and len(self.build_issues) == 0:
+            self.status = TweetStatus.PENDING
+
+    def build(self, only=None):
+        """
+        Run the build steps, running steps that don't depend on each other at the same time
+        :param only: names of steps to re-run along with everything downstream of them, None builds everything
+        """
+        if only is not None:
+            self.clear_step_issues(get_downstream(self.build_steps, only))
+        self.step_timings.update(run_steps(self, self.build_steps, only=only, stop=self.cancelled))
 
     def build_hashtags(self):
-        self.hashtags.append('Election2024')
-        self.hashtags.append('Vote')
+        self.hashtags = ['Election2024', 'Vote']
 
 
 class ScheduleATweet(Tweet):
@@ -141,6 +220,29 @@ class ScheduleATweet(Tweet):
 
     base_string_input = """According to a new filing {contributor_name} gave {amount} to {recipient}, {recipient_description}."""
 
+    validation_rules = [
+        Rule('No last name available', lambda row: not is_blank(row['contributor_last_name'])),
+        Rule('Amount not available', lambda row: row['contribution_receipt_amount'] is not None),
+        Rule('Designation not available', lambda row: row['committee']['designation'] is not None),
+        Rule('No recipient logic implemented for designation',
+             lambda row: row['committee']['designation'] in (None, 'P', 'U', 'B', 'D', 'J')),
+    ]
+
+    build_steps = [
+        BuildStep('build_contributor_name', outputs=['contributor_name']),
+        BuildStep('build_amount', outputs=['amount']),
+        BuildStep('build_recipient', outputs=['designation', 'recipient', 'recipient_description', 'lean', 'party',
+                                              'candidate_first_name', 'candidate_last_name', 'office',
+                                              'state_abbrev', 'state_name', 'candidate_description']),
+        BuildStep('build_emoji', inputs=['party', 'lean'], outputs=['emoji']),
+        BuildStep('build_disclosure_url', outputs=['disclosure_url', 'short_url']),
+        BuildStep('build_hashtags', inputs=['state_name', 'office', 'candidate_first_name', 'candidate_last_name'],
+                  outputs=['hashtags']),
+        BuildStep('get_contributor_media', inputs=['contributor_name'], outputs=['media_objs']),
+        BuildStep('build_tweet_string', inputs=['contributor_name', 'amount', 'recipient', 'recipient_description',
+                                                'short_url', 'hashtags'], outputs=['text']),
+    ]
+
     def __init__(self, schedule_a):
 
         super().__init__()
@@ -164,23 +266,60 @@ class ScheduleATweet(Tweet):
         self.committee_website = None
         self.transaction_id = self.transaction_id = f"{self.schedule_a['transaction_id']}{self.schedule_a['committee']['committee_id']}-{self.schedule_a['contribution_receipt_amount']}"
 
-    def build_contributor_name(self):
+    def get_pdf_url(self):
+        return self.schedule_a['pdf_url']
+
+    def get_row(self):
+        return self.schedule_a
+
+    def get_rank(self):
+        date = self.schedule_a['contribution_receipt_date'] or self.schedule_a['load_date'] or ''
+        return self.schedule_a['contribution_receipt_amount'] or 0, date
+
+    def get_lookups(self):
+        committee = self.schedule_a['committee']
+        lookups = {
+            'short_url': lambda: get_short_url(self.get_pdf_url()),
+            'contributor_image': lambda: image_cache.get_person_image_url(self.get_contributor_name(), get_image)
+        }
+        if committee['designation'] == 'P':
+            lookups['candidate'] = lambda: get_candidate(name=self.schedule_a['contributor_first_name'] + ' ' +
+                                                         self.schedule_a['contributor_last_name'])
+        elif committee['designation'] in ('U', 'B'):
+            # TODO don't hardcode cycle
+            lookups['committee_info'] = lambda: get_committee_info(committee['committee_id'], 2022)
+        elif committee['designation'] == 'D' and committee.get('sponsor_candidate_ids') is not None:
+            lookups['candidate'] = lambda: get_candidate(candidate_id=committee['sponsor_candidate_ids'][0])
+        elif committee['designation'] == 'J':
+            lookups['affiliated_committees'] = lambda: get_affiliated_committees(committee)
+        return lookups
+
+    def get_contributor_name(self):
         """
-        Build a string with name of contributor from schedule a
+        Format the name of the contributor from schedule a
+        :return: name, or None if there is no last name
         """
         first = to_title(self.schedule_a['contributor_first_name'])
         middle = to_title(self.schedule_a['contributor_middle_name'])
         last = to_title(self.schedule_a['contributor_last_name'])
 
         if last is None:
-            self.handle_build_error('No last name available')
-            return
+            return None
 
         if re.search(r'^[a-zA-Z]\.$', first) is not None and middle is not None:
             # First name is just an initial and middle is provided
-            self.contributor_name = f'{first} {middle} {last}'
+            return f'{first} {middle} {last}'
         else:
-            self.contributor_name = f'{first} {last}'
+            return f'{first} {last}'
+
+    def build_contributor_name(self):
+        """
+        Build a string with name of contributor from schedule a
+        """
+        self.contributor_name = self.get_contributor_name()
+
+        if self.contributor_name is None:
+            self.handle_build_error('No last name available')
 
     def build_amount(self):
         """
@@ -210,8 +349,7 @@ class ScheduleATweet(Tweet):
             # When we have a candidate associated with schedule_a
 
             # Candidate isn't always directly listed, so look up always #TODO this logic could be better
-            candidate = get_candidate(name=self.schedule_a['contributor_first_name'] + ' ' +
-                                      self.schedule_a['contributor_last_name'])
+            candidate = self.lookup('candidate')
             self.candidate_first_name = to_title(candidate['first_name'])
             self.candidate_last_name = to_title(candidate['last_name'])
             self.office = to_title(candidate['office_full'])
@@ -234,10 +372,7 @@ class ScheduleATweet(Tweet):
             self.recipient = format_committee_name(self.recipient)
 
             # Search open secrets for information on outside funding group
-            self.lean, os_candidate_name, os_state, os_party = get_committee_info(
-                self.schedule_a['committee']['committee_id'],
-                2022  # TODO don't hardcode
-            )
+            self.lean, os_candidate_name, os_state, os_party = self.lookup('committee_info')
 
             self.lean = self.lean.lower()
             self.recipient_description = f'a {self.lean} group'
@@ -263,8 +398,7 @@ class ScheduleATweet(Tweet):
             # Look at list of sponsor candidates, extract candidate if possible
             candidate_ids = self.schedule_a['committee'].get('sponsor_candidate_ids')
             if candidate_ids is not None:
-                candidate_id = candidate_ids[0]
-                candidate = get_candidate(candidate_id=candidate_id)
+                candidate = self.lookup('candidate')
                 self.candidate_first_name = to_title(candidate['first_name'])
                 self.candidate_last_name = to_title(candidate['last_name'])
                 self.office = to_title(candidate['office_full'])
@@ -281,7 +415,7 @@ class ScheduleATweet(Tweet):
 
         if self.designation == 'J':
             # Joint funding group
-            affiliated_committees = get_affiliated_committees(self.schedule_a['committee'])
+            affiliated_committees = self.lookup('affiliated_committees')
             if affiliated_committees is not None:
                 self.party = format_party(get_party(affiliated_committees))
             self.recipient = to_title(self.schedule_a['committee']['name'])
@@ -304,11 +438,8 @@ class ScheduleATweet(Tweet):
             self.candidate_description = f'{self.party} candidate for President'
 
     def build_disclosure_url(self):
-        if len(self.build_issues) > 0:
-            return
-
-        self.disclosure_url = self.schedule_a['pdf_url']
-        self.short_url = get_short_url(self.disclosure_url)
+        self.disclosure_url = self.get_pdf_url()
+        self.short_url = self.lookup('short_url')
 
     def build_hashtags(self):
         super().build_hashtags()
@@ -345,7 +476,7 @@ class ScheduleATweet(Tweet):
             self.handle_build_error('No usable tweet generated by AI')
 
         self.text = tweet_string + ' ' + self.hashtags
-        self.text = re.sub(r'[^\S\r\n]+', ' ', self.text)  # Remove any extra white space
+        self.text = collapse_spaces(self.text)  # Remove any extra white space
 
         # if self.emoji is not None:
         #     self.text = self.emoji + ' ' + self.text
@@ -385,7 +516,7 @@ class ScheduleATweet(Tweet):
         if len(self.text) > 280:
             logging.info(f'Removing hashtags because tweet is too long. {self.short_url}')
             self.text = tweet_string
-            self.text = re.sub(r'[^\S\r\n]+', ' ', self.text)  # Remove any extra white space
+            self.text = collapse_spaces(self.text)  # Remove any extra white space
 
         if len(self.text) > 280:
             self.handle_build_error('Cannot shorten tweet.')
@@ -394,54 +525,26 @@ class ScheduleATweet(Tweet):
         committee = get_committee(committee_id=self.schedule_a['committee_id'])
         self.committee_website = committee['website']
         if self.committee_website is not None:
-            url = self.committee_website.lower()
-            if not re.match('(?:http|ftp|https)://', url):
-                url = 'http://' + url.strip()
-
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) '
-                              'Chrome/50.0.2661.102 Safari/537.36'}
-            try:
-                response = requests.get(
-                    url,
-                    headers=headers
-                )
-            except:
-                # if we can't get media, just move on
-                return
-            html = response.text
-            soup = BeautifulSoup(html, 'html.parser')
-            media_url = soup.find("meta", {"property": "og:image"})
-            if media_url is None:
-                media_url = soup.find("meta", {"property": "twitter: image"})
-
+            media_url = get_page_image(self.committee_website)
             if media_url is not None:
                 # Upload (padding if a media is already uploaded)
-                self.upload_media_from_url(media_url['content'], len(self.media_objs) == 1)
+                self.upload_media_from_url(media_url, len(self.media_objs) == 1)
 
     def get_contributor_media(self):
+        # Start over, so rebuilding this step doesn't attach the image twice
+        self.media_objs = []
 
         if self.contributor_name is None:
             return
 
         try:
-            media_url = get_image(self.contributor_name)
+            media_url = self.lookup('contributor_image')
         except:
             return  # TODO this is not great handling
 
         if media_url is not None:
             self.upload_media_from_url(media_url)
 
-    def build(self):
-        self.build_contributor_name()
-        self.build_amount()
-        self.build_recipient()
-        self.build_emoji()
-        self.build_disclosure_url()
-        self.build_hashtags()
-        self.get_contributor_media()
-        self.build_tweet_string()
-
 
 class ScheduleETweet(Tweet):
     base_string = """{emoji} {committee_name} spent {amount} for {reason} starting {date} to {os} {candidate_name}, {candidate_description}
@@ -455,6 +558,35 @@ class ScheduleETweet(Tweet):
 
     base_string_input = """{committee_name} spent {amount} for {reason} starting {date} to {os} {candidate_name}, {candidate_description}"""
 
+    validation_rules = [
+        Rule('Amount not available', lambda row: row['expenditure_amount'] is not None),
+        Rule('Could not parse date format',
+             lambda row: parse_date(row['expenditure_date'] or row['dissemination_date']) is not None),
+        Rule('support_oppose_indicator is missing', lambda row: row['support_oppose_indicator'] in ('S', 'O')),
+        Rule('expenditure_description is missing', lambda row: not is_blank(row['expenditure_description'])),
+    ]
+
+    build_steps = [
+        BuildStep('build_contributor_name', outputs=['committee_name']),
+        BuildStep('build_amount', outputs=['amount']),
+        BuildStep('build_date', outputs=['date']),
+        BuildStep('build_candidate', outputs=['candidate_first_name', 'candidate_last_name', 'candidate_name',
+                                              'office', 'state_abbrev', 'party', 'state_name']),
+        BuildStep('build_candidate_media', inputs=['candidate_name'], outputs=['media_objs']),
+        BuildStep('build_candidate_description', inputs=['office', 'state_name', 'party'],
+                  outputs=['candidate_description', 'party']),
+        BuildStep('build_hashtags', inputs=['state_name', 'office', 'candidate_first_name', 'candidate_last_name'],
+                  outputs=['hashtags']),
+        BuildStep('build_os', outputs=['os']),
+        BuildStep('build_lean', outputs=['lean']),
+        BuildStep('build_emoji', inputs=['party', 'lean', 'os', 'candidate_name'], outputs=['emoji']),
+        BuildStep('build_reason', outputs=['reason']),
+        BuildStep('build_disclosure_url', outputs=['disclosure_url', 'short_url']),
+        BuildStep('build_tweet_string', inputs=['committee_name', 'amount', 'date', 'candidate_name',
+                                                'candidate_description', 'os', 'reason', 'short_url', 'hashtags'],
+                  outputs=['text']),
+    ]
+
     def __init__(self, schedule_e):
 
         super().__init__()
@@ -480,18 +612,25 @@ class ScheduleETweet(Tweet):
         self.committee_website = None
         self.transaction_id = f"{self.schedule_e['transaction_id']}{self.schedule_e['committee_id']}-{self.schedule_e['candidate_id']}-{self.schedule_e['expenditure_amount']}"
 
-    def build(self):
-        self.build_contributor_name()
-        self.build_amount()
-        self.build_date()
-        self.build_candidate()
-        self.build_candidate_description()
-        self.build_hashtags()
-        self.build_os()
-        self.build_emoji()
-        self.build_reason()
-        self.build_disclosure_url()
-        self.build_tweet_string()
+    def get_pdf_url(self):
+        return self.schedule_e['pdf_url']
+
+    def get_row(self):
+        return self.schedule_e
+
+    def get_rank(self):
+        date = self.schedule_e['expenditure_date'] or self.schedule_e['dissemination_date'] or ''
+        return self.schedule_e['expenditure_amount'] or 0, date
+
+    def get_lookups(self):
+        lookups = {
+            'short_url': lambda: get_short_url(self.get_pdf_url()),
+            # TODO don't hardcode cycle
+            'committee_info': lambda: get_committee_info(self.schedule_e['committee_id'], 2022)
+        }
+        if self.schedule_e['candidate_id'] is not None:
+            lookups['candidate'] = lambda: get_candidate(candidate_id=self.schedule_e['candidate_id'])
+        return lookups
 
     def build_contributor_name(self):
         self.committee_name = to_title(self.schedule_e['committee']['name'])
@@ -501,30 +640,10 @@ class ScheduleETweet(Tweet):
         committee = get_committee(committee_id=self.schedule_e['committee_id'])
         self.committee_website = committee['website']
         if self.committee_website is not None:
-            url = self.committee_website.lower()
-            if not re.match('(?:http|ftp|https)://', url):
-                url = 'http://' + url.strip()
-
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) '
-                              'Chrome/50.0.2661.102 Safari/537.36'}
-            try:
-                response = requests.get(
-                    url,
-                    headers=headers
-                )
-            except:
-                # if we can't get media just move on
-                return
-            html = response.text
-            soup = BeautifulSoup(html, 'html.parser')
-            media_url = soup.find("meta", {"property": "og:image"})
-            if media_url is None:
-                media_url = soup.find("meta", {"property": "twitter: image"})
-
+            media_url = get_page_image(self.committee_website)
             if media_url is not None:
                 # Upload (padding if a media is already uploaded)
-                self.upload_media_from_url(media_url['content'], len(self.media_objs) == 1)
+                self.upload_media_from_url(media_url, len(self.media_objs) == 1)
 
     def build_amount(self):
         amount = self.schedule_e['expenditure_amount']
@@ -536,22 +655,16 @@ class ScheduleETweet(Tweet):
             self.amount = format_amount(amount)
 
     def build_date(self):
-        date_patterns = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"]
         # dates aren't consistently populated, so look in two places for one
-        input_date = self.schedule_e['expenditure_date'] or self.schedule_e['dissemination_date']
-        for date_pattern in date_patterns:
-            try:
-                dt = datetime.strptime(input_date, date_pattern)
-                self.date = dt.strftime('%b {S}').replace('{S}', str(dt.day) + suffix(dt.day))
-                return
-            except:
-                pass
-
-        self.handle_build_error('Could not parse date format')
+        dt = parse_date(self.schedule_e['expenditure_date'] or self.schedule_e['dissemination_date'])
+        if dt is None:
+            self.handle_build_error('Could not parse date format')
+            return
+        self.date = dt.strftime('%b {S}').replace('{S}', str(dt.day) + suffix(dt.day))
 
     def build_candidate(self):
         if self.schedule_e['candidate_id'] is not None:
-            candidate = get_candidate(candidate_id=self.schedule_e['candidate_id'])
+            candidate = self.lookup('candidate')
 
         if self.schedule_e['candidate_id'] is None or candidate is None:
             candidate = get_candidate(
@@ -570,8 +683,15 @@ class ScheduleETweet(Tweet):
         self.party = format_party(candidate['party_full'])
         self.state_name = abbrev_to_us_state[self.state_abbrev]
 
+    def build_candidate_media(self):
+        # Start over, so rebuilding this step doesn't attach the image twice
+        self.media_objs = []
+
+        if self.candidate_name is None:
+            return
+
         try:
-            media_url = get_image(self.candidate_name)
+            media_url = image_cache.get_person_image_url(self.candidate_name, get_image)
         except:
             return  # TODO this is not great handling
 
@@ -603,11 +723,8 @@ class ScheduleETweet(Tweet):
             self.handle_build_error('support_oppose_indicator is missing')
 
     def build_disclosure_url(self):
-        if len(self.build_issues) > 0:
-            return
-
-        self.disclosure_url = self.schedule_e['pdf_url']
-        self.short_url = get_short_url(self.disclosure_url)
+        self.disclosure_url = self.get_pdf_url()
+        self.short_url = self.lookup('short_url')
 
     def build_hashtags(self):
         super().build_hashtags()
@@ -626,29 +743,17 @@ class ScheduleETweet(Tweet):
             self.handle_build_error('expenditure_description is missing')
             return
 
-        self.reason = to_lower(self.schedule_e['expenditure_description'])
-        self.reason = re.sub(r'\(.*\)', '', self.reason).replace('  ', ' ').strip()
-        self.reason = re.sub(r'-', '', self.reason).replace('  ', ' ').strip()
-        self.reason = self.reason.replace('ie ', ' ').strip()
-        self.reason = re.sub(r'estimate.{0,1}', '', self.reason, flags=re.IGNORECASE).replace('  ', ' ').strip()
+        self.reason = format_reason(self.schedule_e['expenditure_description'])
 
-        # Should we add an S?
-        if re.search(r'.*ing$', self.reason, flags=re.IGNORECASE) is None and \
-                re.search(r'.*s$', self.reason, flags=re.IGNORECASE) is None and \
-                self.reason != 'media':
-            self.reason = self.reason + 's'
+    def build_lean(self):
+        # Search open secrets for information on outside funding group
+        self.lean, os_candidate_name, os_state, os_party = self.lookup('committee_info')
 
     def build_emoji(self):
         rep_emoji = "🚨🐘💸"
         dem_emoji = "️🗳️🐴💸"
         ind_emoji = "⭐💸"
 
-        # Search open secrets for information on outside funding group
-        self.lean, os_candidate_name, os_state, os_party = get_committee_info(
-            self.schedule_e['committee_id'],
-            2022  # TODO don't hardcode
-        )
-
         if self.party == 'Republican' or self.lean == 'conservative':
             if self.os == 'support':
                 self.emoji = rep_emoji
@@ -684,7 +789,7 @@ class ScheduleETweet(Tweet):
             self.handle_build_error('No usable tweet generated by AI')
 
         self.text = tweet_string + ' ' + self.hashtags
-        self.text = re.sub(r'[^\S\r\n]+', ' ', self.text)  # Remove any extra white space
+        self.text = collapse_spaces(self.text)  # Remove any extra white space
 
         # TODO clean up this very hacky fix
         # if len(self.text) > 280:
@@ -722,74 +827,84 @@ class ScheduleETweet(Tweet):
         if len(self.text) > 280:
             logging.info(f'Removing hashtags because tweet is too long. {self.short_url}')
             self.text = tweet_string
-            self.text = re.sub(r'[^\S\r\n]+', ' ', self.text)  # Remove any extra white space
+            self.text = collapse_spaces(self.text)  # Remove any extra white space
 
         if len(self.text) > 280:
             self.handle_build_error('Cannot shorten tweet.')
 
-    def gen_reply_tweet(self):
-        reply_tweet = Tweet()
-        filename = generate_committee_chart(
-            self.committee_name,
-            self.schedule_e['committee_id'],
-            self.os,
-            self.schedule_e['expenditure_amount'],
-            self.candidate_name
-        )
-        if filename is None:
-            reply_tweet.handle_build_error(f'No funding chart generated.')
-        else:
-            reply_tweet.upload_media_from_file(filename)
-            reply_tweet.text = f'How {self.committee_name} raised {self.amount} to {self.os} {self.candidate_name} 👇'
-            reply_tweet.in_reply_to_tweet_id = self.response.data['id']
-        return reply_tweet
-
-
-def to_title(text):
-    """
-    Coverts string to title and strips empty white space. Returns empty sting if text is None
-    :param text: input text
-    :return: title case text
-    """
-    if text is not None:
-        text = titlecase.titlecase(text.lower())
-        return text.strip()
-    else:
-        return None
+    def get_reply_request(self):
+        return {
+            'committee_name': self.committee_name,
+            'committee_id': self.schedule_e['committee_id'],
+            'os': self.os,
+            'expenditure_amount': self.schedule_e['expenditure_amount'],
+            'amount': self.amount,
+            'candidate_name': self.candidate_name
+        }
 
 
-def to_lower(text):
+def gen_reply_tweet(request, tweet_id):
     """
-    Coverts string to lower and strips empty white space. Returns empty sting if text is None
-    :param text: input text
-    :return: title case text
+    Build the funding chart reply to a posted tweet
+    :param request: reply request from get_reply_request
+    :param tweet_id: id of the tweet to reply to
+    :return: Tweet
     """
-    if text is not None:
-        return text.lower().strip()
+    reply_tweet = Tweet()
+    chart = generate_committee_chart(
+        request['committee_name'],
+        request['committee_id'],
+        request['os'],
+        request['expenditure_amount'],
+        request['candidate_name']
+    )
+    if chart is None:
+        reply_tweet.handle_build_error(f'No funding chart generated.')
     else:
-        return None
+        reply_tweet.upload_media_from_buffer(chart, 'funding_chart.png')
+        reply_tweet.text = f'How {request["committee_name"]} raised {request["amount"]} to {request["os"]} ' \
+                           f'{request["candidate_name"]} 👇'
+        reply_tweet.in_reply_to_tweet_id = tweet_id
+    return reply_tweet
 
 
-def format_party(text):
+def pad_to_aspect(image_bytes):
     """
-    Coverts string with party
-    :param text: input text
-    :return: title case text
+    Pad an image with black so it is at least 2:1.5 tall, keeping its original width
+    :param image_bytes: encoded image
+    :return: encoded image in the same format, unchanged if no padding is needed
     """
-    return to_title(text).replace('Party', '').strip()
+    from PIL import Image, ImageOps
+    img = Image.open(BytesIO(image_bytes))
+    image_format = img.format
+    required_height = (2/1.5) * img.width
+    required_padding = int(required_height - img.height)
+    if required_padding <= 0:
+        return image_bytes
+    img = ImageOps.expand(img, border=required_padding // 2, fill='black')
+    img = img.crop((required_padding // 2, 0, img.width - required_padding // 2, img.height))
+    buffer = BytesIO()
+    img.save(buffer, format=image_format)
+    return buffer.getvalue()
 
 
 def get_short_url(url):
     """
-    Use API to shorten URL
+    Use API to shorten URL, reusing the short link if this URL was shortened before
     :param url: URL to shorten
     :return: short link
     """
+    cache = get_cache()
+    short_url = cache.get('short_url', url)
+    if short_url is not None:
+        return short_url
+
+    from credentials import tiny_url_api_token
     logging.info('URL shorten')
     endpoint = "https://api.tinyurl.com/create/"
     authorization = f'Bearer {tiny_url_api_token}'
     headers = {"Authorization": authorization}
-    response = requests.post(
+    response = http_client.post(
         endpoint,
         headers=headers,
         params={
@@ -797,117 +912,285 @@ def get_short_url(url):
         }
     )
     if response.status_code == 200:
-        return response.json()['data']['tiny_url']
+        short_url = response.json()['data']['tiny_url']
+        cache.set('short_url', url, short_url)
+        return short_url
 
 
-def format_committee_name(committee_name):
-    # When the name ends with "Fund"
-    if re.search(r'fund$', committee_name, flags=re.IGNORECASE) is not None and \
-            not re.search(r'^the', committee_name, flags=re.IGNORECASE):
-        committee_name = 'The ' + committee_name
+def shorten_urls(urls, workers=8):
+    """
+    Shorten many URLs at once, only calling the API for URLs that haven't been shortened before
+    :param urls: URLs to shorten
+    :param workers: most API calls to make at once
+    :return: a dictionary of URL to short link, URLs that couldn't be shortened are left out
+    """
+    urls = list(dict.fromkeys(url for url in urls if url))
+    if len(urls) == 0:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(workers, len(urls))) as executor:
+        short_urls = executor.map(get_short_url, urls)
+    return {url: short_url for url, short_url in zip(urls, short_urls) if short_url is not None}
 
-    # remove anything in parens
-    committee_name = re.sub(r'\(.*\)', '', committee_name).replace('  ', ' ')
 
-    # remove anything with dba and after
-    committee_name = re.sub(r'\sdba.*$', '', committee_name, flags=re.IGNORECASE)
+def build_tweet(tweet):
+    tweet.build()
 
-    # Should the entire name be capitalized?
-    # When its one word
-    if re.search(r'^\w+$', committee_name) is not None:
-        committee_name = committee_name.upper()
 
-    committee_name = re.sub(r'\b(pac)\b', 'PAC', committee_name, flags=re.IGNORECASE)  # Capitalize PAC
-    committee_name = re.sub(r'\b(usa)\b', 'USA', committee_name, flags=re.IGNORECASE)  # Capitalize USA
-    committee_name = re.sub(r'\b(nra)\b', 'NRA', committee_name, flags=re.IGNORECASE)  # Capitalize NRA
-    committee_name = re.sub(r'\b(goa)\b', 'GOA', committee_name, flags=re.IGNORECASE)  # Capitalize GOA
+async def prefetch_lookups(tweet, limiter):
+    """
+    Run all of a tweet's independent lookups concurrently. Failed lookups are left out and retried
+    in build, so errors surface the same way they do in a sequential build.
+    :param tweet: Tweet
+    :param limiter: asyncio.Semaphore bounding concurrent network calls
+    """
+    async def run(fn):
+        async with limiter:
+            return await asyncio.to_thread(fn)
+
+    lookups = {name: fn for name, fn in tweet.get_lookups().items() if name not in tweet.lookups}
+    results = await asyncio.gather(*[run(fn) for fn in lookups.values()], return_exceptions=True)
+    for name, result in zip(lookups, results):
+        if isinstance(result, Exception):
+            logging.info(f'Prefetch of {name} failed for {tweet.transaction_id}: {result}')
+        else:
+            tweet.lookups[name] = result
 
-    return committee_name
 
+def make_async_builder(loop, limiter):
+    """
+    Make a builder for the fetch functions, run from a worker thread, that prefetches each tweet's
+    lookups concurrently on the event loop before building
+    :param loop: running event loop
+    :param limiter: asyncio.Semaphore bounding concurrent network calls
+    :return: builder function
+    """
+    def builder(tweet):
+        asyncio.run_coroutine_threadsafe(prefetch_lookups(tweet, limiter), loop).result()
+        if not tweet.cancelled.is_set():
+            tweet.build()
+    return builder
 
-def format_amount(amount):
-    amount = round(amount)
-    if amount >= 1e6:
-        end = 'M'
-        amount = round(amount / 1e6, 1)
-    else:
-        end = ''
 
-    return locale.currency(amount, grouping=True).rstrip('0').rstrip('.') + end
+def build_tweets(tweets, transactions, post_cap, builder=build_tweet, workers=1):
+    """
+    Build tweets until post_cap of them are ready to post. Up to `workers` tweets are built at once, but
+    they are still accepted in their original order, so a slow build is never overtaken by a later one.
+    Each transaction is claimed before it is built, so other workers skip it. Builds started past the cap
+    are dropped: they stop before their next build step, and their claims are released once they have.
+    :param tweets: iterable of unbuilt tweets in priority order
+    :param transactions: DedupStore of handled transactions
+    :param post_cap: number of tweets ready to post to stop at
+    :param builder: function that builds a tweet
+    :param workers: number of tweets to build at once
+    :return: list of built tweets, including blocked ones
+    """
+    def build(tweet):
+        try:
+            builder(tweet)
+        except Exception as error:
+            tweet.handle_build_error('Unknown error: ' + str(error))
+        return tweet
+
+    def release(transaction_id):
+        return lambda future: transactions.release(transaction_id)
+
+    tweets = iter(tweets)
+    built = []
+    total_posts = 0
+    in_flight = deque()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while total_posts < post_cap:
+            while len(in_flight) < workers:
+                tweet = next(tweets, None)
+                if tweet is None:
+                    break
+                if tweet.transaction_id in transactions or not transactions.claim(tweet.transaction_id):
+                    logging.info(f'Skipping already posted or claimed transaction: {tweet.transaction_id}')
+                    continue
+                in_flight.append((tweet, executor.submit(build, tweet)))
+            if len(in_flight) == 0:
+                break
+            tweet, future = in_flight.popleft()
+            built.append(future.result())
+            if tweet.status == TweetStatus.PENDING:
+                total_posts += 1
+        if total_posts == post_cap:
+            logging.info(f'Hit Post Cap')
+    finally:
+        # Don't wait for dropped builds, they finish their current step in the background
+        for tweet, future in in_flight:
+            tweet.cancelled.set()
+            future.add_done_callback(release(tweet.transaction_id))
+        executor.shutdown(wait=False, cancel_futures=True)
+    return built
 
 
-def fetch_schedule_a_data_and_build_tweets(min_load_date, min_amount, transactions, post_cap, **kwargs):
+def reject_invalid(tweets, transactions):
     """
-    :param transactions:
+    Drop tweets whose raw rows fail their validation rules, a page at a time and before any network calls.
+    Rejected transactions are recorded as handled, as they would be had they failed to build. Transactions
+    already handled are dropped without being validated, so they aren't counted as rejected again.
+    :param tweets: iterable of unbuilt tweets
+    :param transactions: DedupStore of handled transactions
+    :return: a generator of the tweets that passed
+    """
+    rejections = Counter()
+    try:
+        for page in iter_chunks(tweets, page_size):
+            for tweet in page:
+                if tweet.transaction_id in transactions:
+                    continue
+                reasons = tweet.validate()
+                if len(reasons) == 0:
+                    yield tweet
+                    continue
+                rejections.update(reasons)
+                for reason in reasons:
+                    metrics.count('rejected', reason=reason)
+                transactions.add(tweet.transaction_id)
+    finally:
+        if len(rejections) > 0:
+            logging.info('Rejected before building: ' + ', '.join(f'{reason} ({n})' for reason, n in
+                                                                  rejections.most_common()))
+
+
+def select_top_tweets(tweets, transactions, size):
+    """
+    Stream unbuilt tweets through a bounded heap, keeping the largest and most recent ones that haven't been
+    handled yet, so enrichment is only spent on tweets that could be posted
+    :param tweets: iterable of unbuilt tweets
+    :param transactions: DedupStore of handled transactions
+    :param size: number of tweets to keep
+    :return: list of tweets, highest ranked first
+    """
+    heap = []
+    for i, tweet in enumerate(tweets):
+        if tweet.transaction_id in transactions:
+            continue
+        # On equal rank the earlier tweet wins, as it has the larger -i
+        item = (tweet.get_rank(), -i, tweet)
+        if len(heap) < size:
+            heapq.heappush(heap, item)
+        elif item[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, item)
+    selected = [tweet for _, _, tweet in sorted(heap, key=lambda item: item[:2], reverse=True)]
+    logging.info(f'Selected {len(selected)} tweets to build')
+    return selected
+
+
+def fetch_schedule_a_data_and_build_tweets(min_load_date, min_amount, transactions, post_cap, builder=build_tweet,
+                                           workers=1, shard=None, **kwargs):
+    """
+    :param transactions: DedupStore of handled transactions
     :param min_load_date:
     :param min_amount:
     :param post_cap:
+    :param builder: function that builds a tweet
+    :param workers: number of tweets to build at once
+    :param shard: (index, count) to only build this worker's share of the transactions, None for all
     :param kwargs:
     :return:
     """
     logging.info('Starting fetch_schedule_a_data_and_build_tweets')
-    schedule_as = get_schedule_a(min_load_date=min_load_date, min_amount=min_amount, **kwargs)
-
-    tweets = []
-    total_posts = 0
-
-    logging.info(f'Retrieved {len(schedule_as)} transactions')
-    for schedule_a in schedule_as:
-        tweet = ScheduleATweet(schedule_a=schedule_a)
-        # No duplicates
-        if tweet.transaction_id in transactions:
-            tweet.status = TweetStatus.BLOCKED
-            logging.info(f'Skipping already posted transaction: {tweet.transaction_id}')
-            continue
-        if total_posts == post_cap:
-            logging.info(f'Hit Post Cap')
-            break
-        try:
-            tweet.build()
-            total_posts += 1
-        except Exception as error:
-            tweet.handle_build_error('Unknown error: ' + str(error))
-        tweets.append(tweet)
-        transactions.append(tweet.transaction_id)
+    schedule_as = iter_schedule_a(min_load_date=min_load_date, min_amount=min_amount, **kwargs)
+    counter = {'retrieved': 0}
+
+    def gen_tweets():
+        for schedule_a in schedule_as:
+            counter['retrieved'] += 1
+            tweet = ScheduleATweet(schedule_a=schedule_a)
+            if in_shard(tweet.transaction_id, shard):
+                yield tweet
+
+    selected = select_top_tweets(reject_invalid(gen_tweets(), transactions), transactions, post_cap + selection_spill)
+    tweets = build_tweets(prefetch_short_urls(selected, transactions), transactions, post_cap, builder, workers)
+    logging.info(f'Retrieved {counter["retrieved"]} transactions')
     logging.info('Completed fetch_schedule_a_data_and_build_tweets')
     return tweets
 
 
-def fetch_schedule_e_data_and_build_tweets(min_load_date, min_amount, min_filing_date, transactions, post_cap, **kwargs):
+def fetch_schedule_e_data_and_build_tweets(min_load_date, min_amount, min_filing_date, transactions, post_cap,
+                                           builder=build_tweet, workers=1, shard=None, **kwargs):
     """
     :param min_filing_date:
-    :param transactions:
+    :param transactions: DedupStore of handled transactions
     :param min_load_date:
     :param min_amount:
     :param post_cap:
+    :param builder: function that builds a tweet
+    :param workers: number of tweets to build at once
+    :param shard: (index, count) to only build this worker's share of the transactions, None for all
     :param kwargs:
     :return:
     """
     logging.info('Starting fetch_schedule_e_data_and_build_tweets')
-    schedule_es = get_schedule_e(min_load_date=min_load_date, min_filing_date=min_filing_date, min_amount=min_amount,
-                                 **kwargs)
-    tweets = []
-    total_posts = 0
+    schedule_es = iter_schedule_e(min_load_date=min_load_date, min_filing_date=min_filing_date, min_amount=min_amount,
+                                  **kwargs)
+    counter = {'retrieved': 0}
+
+    def gen_tweets():
+        for schedule_e in schedule_es:
+            counter['retrieved'] += 1
+            tweet = ScheduleETweet(schedule_e=schedule_e)
+            if in_shard(tweet.transaction_id, shard):
+                yield tweet
+
+    selected = select_top_tweets(reject_invalid(gen_tweets(), transactions), transactions, post_cap + selection_spill)
+    resolve_candidates(selected)
+    tweets = build_tweets(prefetch_short_urls(selected, transactions), transactions, post_cap, builder, workers)
+    logging.info(f'Retrieved {counter["retrieved"]} transactions')
+    logging.info('Completed fetch_schedule_e_data_and_build_tweets')
+    return tweets
 
-    logging.info(f'Retrieved {len(schedule_es)} transactions')
-    for schedule_e in schedule_es:
-        tweet = ScheduleETweet(schedule_e=schedule_e)
-        # No duplicates
-        if tweet.transaction_id in transactions:
-            tweet.handle_build_error('Duplicate transaction')
-            logging.info(f'Skipping already posted transaction: {tweet.transaction_id}')
-            continue
-        if total_posts == post_cap:
-            logging.info(f'Hit Post Cap')
-            break
+
+def iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def prefetch_short_urls(tweets, transactions):
+    """
+    Shorten the disclosure URLs of each page's new tweets in one concurrent batch before they are built.
+    Only the first short_url_prefetch_limit new tweets of a page are shortened, as most are never built.
+    :param tweets: iterable of unbuilt tweets
+    :param transactions: DedupStore of handled transactions
+    :return: a generator of the same tweets
+    """
+    for page in iter_chunks(tweets, page_size):
+        new_tweets = [tweet for tweet in page if tweet.transaction_id not in transactions]
+        new_tweets = new_tweets[:short_url_prefetch_limit]
         try:
-            tweet.build()
-            total_posts += 1
+            short_urls = shorten_urls(tweet.get_pdf_url() for tweet in new_tweets)
         except Exception as error:
-            tweet.handle_build_error('Unknown error: ' + str(error))
-        tweets.append(tweet)
-    logging.info('Completed fetch_schedule_e_data_and_build_tweets')
-    return tweets
+            logging.info(f'Batch URL shortening failed: {error}')
+            short_urls = {}
+        for tweet in new_tweets:
+            if tweet.get_pdf_url() in short_urls:
+                tweet.lookups['short_url'] = short_urls[tweet.get_pdf_url()]
+        yield from page
+
+
+def resolve_candidates(tweets):
+    """
+    Look up the candidates of schedule e tweets in one batch, leaving any that fail to be looked up one by one
+    during build
+    :param tweets: list of unbuilt ScheduleETweet
+    """
+    try:
+        candidates = get_candidates_by_id(tweet.schedule_e['candidate_id'] for tweet in tweets)
+    except Exception as error:
+        logging.info(f'Batch candidate lookup failed: {error}')
+        return
+    for tweet in tweets:
+        if tweet.schedule_e['candidate_id'] in candidates:
+            tweet.lookups['candidate'] = candidates[tweet.schedule_e['candidate_id']]
 
 
 def suffix(d):
@@ -0,0 +1,134 @@
+import time
+import types
+import threading
+import requests
+import metrics
+import replay
+
+
+class TwitterClients:
+    """
+    Authenticated Twitter clients created once and shared by every tweet. The v2 client posts tweets and the
+    v1.1 API uploads media, each keeping its HTTP session open between calls.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.lock = threading.Lock()
+        self.post_lock = threading.Lock()
+        self.upload_lock = threading.Lock()
+        self._client = None
+        self._api = None
+        # Posting limits reported by the last response, for each window: remaining posts and reset time
+        self.rate_limits = {}
+
+    @property
+    def client(self):
+        import tweepy
+        with self.lock:
+            if self._client is None:
+                self._client = tweepy.Client(
+                    consumer_key=self.keys['api_key'],
+                    consumer_secret=self.keys['api_secret_key'],
+                    access_token=self.keys['access_token'],
+                    access_token_secret=self.keys['access_token_secret'],
+                    # Raw responses, so the rate limit headers can be read
+                    return_type=requests.Response
+                )
+            return self._client
+
+    @property
+    def api(self):
+        import tweepy
+        with self.lock:
+            if self._api is None:
+                auth = tweepy.OAuth1UserHandler(
+                    self.keys['api_key'],
+                    self.keys['api_secret_key'],
+                    self.keys['access_token'],
+                    self.keys['access_token_secret']
+                )
+                self._api = tweepy.API(auth)
+            return self._api
+
+    def create_tweet(self, **kwargs):
+        """
+        Post a tweet with the v2 API
+        :param kwargs: passed to tweepy.Client.create_tweet
+        :return: tweepy.Response
+        """
+        import tweepy
+
+        def post():
+            client = self.client
+            try:
+                response = client.create_tweet(**kwargs)
+            except tweepy.HTTPException as error:
+                self.update_rate_limits(error.response.headers)
+                raise
+            self.update_rate_limits(response.headers)
+            return response.json()
+
+        def stub():
+            return {'data': {'id': replay.get_recorder().synthetic_id(), 'text': kwargs.get('text')}}
+
+        with self.post_lock, metrics.span('post'):
+            body = replay.call('twitter_create_tweet', kwargs, post, stub=stub)
+        return tweepy.Response(body.get('data'), body.get('includes', {}), body.get('errors', []), body.get('meta', {}))
+
+    def update_rate_limits(self, headers):
+        """
+        Record the posting limits from response headers. Twitter reports a per-window limit and a 24 hour
+        limit per user.
+        :param headers: response headers
+        """
+        for window, prefix in (('window', 'x-rate-limit'), ('user_24h', 'x-user-limit-24hour')):
+            remaining = headers.get(f'{prefix}-remaining')
+            reset = headers.get(f'{prefix}-reset')
+            if remaining is not None and reset is not None:
+                self.rate_limits[window] = (int(remaining), float(reset))
+
+    def rate_limit_wait(self):
+        """
+        :return: seconds until posting is allowed again, 0 if it is allowed now
+        """
+        now = time.time()
+        waits = [reset - now for remaining, reset in self.rate_limits.values() if remaining <= 0 and reset > now]
+        return max(waits, default=0)
+
+    def upload_media(self, filename, file=None):
+        """
+        Upload media with the v1.1 API
+        :param filename: name of the file, also used to guess the media type when file is given
+        :param file: file object to read instead of opening filename
+        :return: media object
+        """
+        def upload():
+            return self.api.media_upload(filename, file=file)
+
+        def stub():
+            return types.SimpleNamespace(media_id=replay.get_recorder().synthetic_id())
+
+        with self.upload_lock, metrics.span('media_upload'):
+            # Only the media id is used, so that's all a recording keeps
+            return replay.call('twitter_upload_media', filename, upload,
+                               encode=lambda media: {'media_id': media.media_id},
+                               decode=lambda value: types.SimpleNamespace(**value), stub=stub)
+
+
+_clients = None
+_clients_lock = threading.Lock()
+
+
+def get_twitter_clients():
+    """
+    Get the process-wide Twitter clients
+    :return: TwitterClients
+    """
+    global _clients
+    if _clients is None:
+        with _clients_lock:
+            if _clients is None:
+                from credentials import twitter_keys
+                _clients = TwitterClients(twitter_keys)
+    return _clients
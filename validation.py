@@ -0,0 +1,61 @@
+import logging
+from datetime import datetime
+
+date_patterns = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"]
+
+
+class Rule:
+    """
+    A check on a raw FEC row that only looks at the row itself, so it can run before any network calls
+    """
+
+    def __init__(self, reason, check):
+        """
+        :param reason: why a row failing the check is rejected, matching the build error it would cause
+        :param check: function taking the row, returns True if the row passes
+        """
+        self.reason = reason
+        self.check = check
+
+    def __repr__(self):
+        return f'Rule({self.reason})'
+
+
+def get_rejections(row, rules):
+    """
+    :param row: FEC row
+    :param rules: list of Rule
+    :return: list of reasons the row is rejected, empty if it passes every rule. A rule that fails on a
+    malformed row, e.g. one missing a field, rejects the row rather than raising.
+    """
+    reasons = []
+    for rule in rules:
+        try:
+            passed = rule.check(row)
+        except Exception as error:
+            logging.info(f'Rule {rule.reason!r} failed on a malformed row: {type(error).__name__}: {error}')
+            reasons.append(f'Malformed row: {rule.reason}')
+            continue
+        if not passed:
+            reasons.append(rule.reason)
+    return reasons
+
+
+def parse_date(text):
+    """
+    Parse a date in one of the formats the FEC API uses
+    :param text: date string
+    :return: datetime, or None if it can't be parsed
+    """
+    if not isinstance(text, str):
+        return None
+    for date_pattern in date_patterns:
+        try:
+            return datetime.strptime(text, date_pattern)
+        except ValueError:
+            pass
+    return None
+
+
+def is_blank(value):
+    return value is None or (isinstance(value, str) and value.strip() == '')
@@ -1,9 +1,9 @@
-import requests
+import http_client
 
 def search_for_person(name):
     endpoint = "https://en.wikipedia.org/w/api.php"
 
-    response = requests.get(
+    response = http_client.get(
         endpoint,
         params={
             'action': 'opensearch',
@@ -22,7 +22,7 @@ def search_for_person(name):
 
 def get_lead_image(pageid):
     endpoint = f'https://en.wikipedia.org/api/rest_v1/page/media-list/{pageid}'
-    response = requests.get(
+    response = http_client.get(
         endpoint,
         params={
         }